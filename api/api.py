@@ -1,14 +1,26 @@
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from http import HTTPStatus
 from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from array import array
 import datetime
 import time
 import argparse
+import asyncio
+import ctypes
+import http.client
+import io
+import struct
+import zlib
 import logging as log
 import json
 import os
 import sys
 import subprocess
 import random
+import re
+import select
+import socket
 from pprint import pprint
 import threading
 
@@ -17,17 +29,81 @@ if sys.version_info[0] < 3:
     print('Please use Python 3\nExample: python3 {}'.format(sys.argv[0]))
     sys.exit(1)
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.httpcache import CachedBody, cached_response
+from app.shm import SHM_PATH, TelemetryWriter
+
 
 API_DATA = []
+API_SNAPSHOT = None
+SNAPSHOT_COND = threading.Condition()
+SNAPSHOT_HOOKS = []
+SSE_KEEPALIVE = 15
+REQUEST_COUNT = {}
+REQUEST_LOCK = threading.Lock()
+API_ROUTES = ('/', '/api/v1', '/api/v1/history', '/api/v1/stream', '/metrics')
 GPU_TYPE = ['amd', 'nvidia']
+NVIDIA_BACKEND = ['smi', 'stream', 'nvml']
+SERVER_TYPE = ['threaded', 'asyncio']
+
+HISTORY_METRICS = ('temp', 'fan', 'core_load', 'power_current', 'core_clock', 'mem_clock', 'mem_used')
+HISTORY_TIERS = (
+    (1, 900),       # 1 second buckets, 15 minutes
+    (60, 1440),     # 1 minute buckets, 1 day
+    (3600, 720),    # 1 hour buckets, 30 days
+)
+
+PROMETHEUS_LABELS = ('name', 'bus_id', 'uuid', 'card_model', 'vendor')
+PROMETHEUS_METRICS = (
+    ('temp', 'rig_gpu_temperature_celsius', 'GPU temperature'),
+    ('fan', 'rig_gpu_fan_percent', 'Fan speed'),
+    ('core_load', 'rig_gpu_core_load_percent', 'GPU core utilization'),
+    ('mem_load', 'rig_gpu_memory_load_percent', 'GPU memory controller utilization'),
+    ('power_current', 'rig_gpu_power_watts', 'Current power draw'),
+    ('power_max', 'rig_gpu_power_max_watts', 'Max power draw'),
+    ('core_clock', 'rig_gpu_core_clock_mhz', 'Core clock'),
+    ('mem_clock', 'rig_gpu_memory_clock_mhz', 'Memory clock'),
+    ('mem_used', 'rig_gpu_memory_used_mib', 'Used GPU memory'),
+    ('mem_total', 'rig_gpu_memory_total_mib', 'Total GPU memory'),
+)
+
+COLUMNAR_VERSION = 1
+COLUMNAR_STATIC = ('index', 'name', 'card_model', 'uuid', 'bus_id', 'driver_version', 'vbios_version', 'vendor')
+COLUMNAR_METRICS = (
+    'temp', 'fan', 'core_load', 'mem_load', 'power_current', 'power_max',
+    'core_clock', 'mem_clock', 'mem_used', 'mem_total',
+)
+# magic, version, flags (1 - static block follows), schema id, ts, cards, metrics
+BINARY_HEADER = struct.Struct('<4sBBIdHH')
+BINARY_MAGIC = b'RIGB'
+BINARY_MISSING = -2 ** 31
+
+NETLINK_KOBJECT_UEVENT = 15
+
+NVML_SUCCESS = 0
+NVML_ERROR_NOT_SUPPORTED = 3
+NVML_TEMPERATURE_GPU = 0
+NVML_CLOCK_SM = 1
+NVML_CLOCK_MEM = 2
 
 parser = argparse.ArgumentParser(description='Miner API')
 
 parser.add_argument('--api', action='store_true', default=False, help='Start API server')
 parser.add_argument('--getdata-interval', type=int, default=3, help='Get data interval')
 parser.add_argument('--gpu-type', type=str, action='store', required=True, choices=GPU_TYPE)
+parser.add_argument('--nvidia-backend', type=str, default=NVIDIA_BACKEND[0], choices=NVIDIA_BACKEND,
+                    help='smi - run nvidia-smi on every refresh, stream - keep one nvidia-smi running in loop mode, '
+                         'nvml - read libnvidia-ml directly')
+parser.add_argument('--nvml-lib', type=str, default='libnvidia-ml.so.1', help='NVML shared library (nvml backend)')
 parser.add_argument('--debug-delay', type=int, default=0)
 parser.add_argument('--debug', action='store_true', default=False)
+parser.add_argument('--server', type=str, default=SERVER_TYPE[0], choices=SERVER_TYPE,
+                    help='threaded - thread per connection, asyncio - HTTP/1.1 keep-alive event loop')
+parser.add_argument('--max-connections', type=int, default=1024, help='Max open connections (asyncio server)')
+parser.add_argument('--keepalive-timeout', type=int, default=60, help='Idle keep-alive timeout (asyncio server)')
+parser.add_argument('--long-poll-timeout', type=int, default=30, help='Max wait for /api/v1?wait_for_ts=')
+parser.add_argument('--shm-path', type=str, default=SHM_PATH, help='Shared memory telemetry file for local readers, empty to disable')
 parser.add_argument('--fake', action='store_true', default=False, help='Test mode, enable fake data')
 
 
@@ -70,20 +146,8 @@ class NvidiaGpu():
         if args.fake:
             log.info(' '.join(self.nvidia_smi))
 
-        ts = datetime.datetime.now()
-        ts_delta = ts - self.last_ts
-
-        if not self.cards_data:
-            log.debug('No cards data, running nvidia-smi...')
-            self.run_cmd()
-
-        if ts_delta.total_seconds() > args.getdata_interval:
-            self.last_ts = datetime.datetime.now()
-            self.run_cmd()
-        else:
-            log.debug('Using cached data, next update in {} seconds ...'.format(round(args.getdata_interval - ts_delta.total_seconds())))
-
-        return self.cards_data
+        self.last_ts = datetime.datetime.now()
+        return self.run_cmd()
 
     def run_cmd(self):
         if args.debug_delay:
@@ -94,56 +158,314 @@ class NvidiaGpu():
         proc = subprocess.Popen(self.nvidia_smi, stderr=subprocess.PIPE, stdout=subprocess.PIPE).communicate()
         for card in proc[0].decode('utf-8').split('\n'):
             if card:
-                d = dict(zip(self.cards_keys, card.split(', ')))
-                index = d.get('index')
+                self.cards_data.append(self.parse_card(card))
+        log.debug(self.cards_data)
+        return self.cards_data
+
+    def parse_card(self, line):
+        d = dict(zip(self.cards_keys, line.split(', ')))
+        index = int(d.get('index'))
+
+        d.update(dict(
+            index=index,
+            name='card{0:02d}'.format(index),
+            temp=int(d.get('temp')),
+            power_current=round(float(d.get('power_current'))),
+            mem_load=int(d.get('mem_load')),
+            core_load=int(d.get('core_load')),
+            core_clock=int(d.get('core_clock')),
+            mem_used=int(d.get('mem_used')),
+            mem_total=int(d.get('mem_total')),
+            mem_clock=int(d.get('mem_clock')),
+            fan=int(d.get('fan')),
+            vendor=GPU_TYPE[1],
+        ))
+        return d
+
+
+class NvidiaGpuStream(NvidiaGpu):
+    """
+    Keeps one nvidia-smi running in loop mode (-lms) and parses its output
+    in a background thread. nvidia-smi prints all cards at once on every loop,
+    so a snapshot is complete when the card index wraps or the output pauses.
+    If nvidia-smi stalls or exits the data is cleared, a stale snapshot
+    must not look like working cards.
+    """
+    def __init__(self, interval=args.getdata_interval):
+        super().__init__()
+        self.proc = None
+        self.flush_timeout = 0.1                # output pause which ends a snapshot
+        self.stall_timeout = interval * 3 + 5   # no output at all, nvidia-smi is hung
+        self.respawn_delay = 1
+        self.kill_timeout = 5
+        self.nvidia_smi_loop = self.nvidia_smi + ('-lms', str(interval * 1000))
+
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def get_data(self):
+        if args.fake:
+            log.info(' '.join(self.nvidia_smi_loop))
+        return self.cards_data
+
+    def publish(self, cards):
+        self.cards_data = cards
+        self.last_ts = datetime.datetime.now()
+        log.debug(cards)
+
+    def clear(self):
+        """
+        last_ts is kept, it is the time of the last real sample
+        """
+        if self.cards_data:
+            log.error('nvidia-smi data is stale, clearing it')
+        self.cards_data = []
+
+    def stop_proc(self):
+        self.proc.kill()
+        try:
+            self.proc.wait(timeout=self.kill_timeout)
+        except subprocess.TimeoutExpired:
+            # stuck in the driver (D state), it can not be reaped now
+            log.error('nvidia-smi pid {} does not exit after kill'.format(self.proc.pid))
+            return False
+        return True
+
+    def read_loop(self):
+        while True:
+            try:
+                self.proc = subprocess.Popen(self.nvidia_smi_loop, stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
+            except OSError as e:
+                log.error('Error running nvidia-smi: {}'.format(e))
+            else:
+                log.debug('nvidia-smi started, pid {}'.format(self.proc.pid))
+                self.read_proc()
+                self.clear()
+                if self.stop_proc():
+                    log.error('nvidia-smi exited with code {}, respawning ...'.format(self.proc.returncode))
+            self.clear()
+            time.sleep(self.respawn_delay)
+
+    def read_proc(self):
+        fd = self.proc.stdout.fileno()
+        buf = b''
+        cards = []
+
+        while True:
+            ready, _, _ = select.select([fd], [], [], self.flush_timeout if cards else self.stall_timeout)
+            if not ready:
+                if not cards:
+                    log.error('No output from nvidia-smi in {} seconds'.format(self.stall_timeout))
+                    return
+                self.publish(cards)
+                cards = []
+                continue
+
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return
+
+            *lines, buf = (buf + chunk).split(b'\n')
+            for line in lines:
+                line = line.decode('utf-8').strip()
+                if not line:
+                    continue
+                try:
+                    card = self.parse_card(line)
+                except (TypeError, ValueError):
+                    log.error('Error parsing nvidia-smi output: \"{}\"'.format(line))
+                    continue
+                if cards and card['index'] <= cards[-1]['index']:
+                    self.publish(cards)
+                    cards = []
+                cards.append(card)
+
+
+class NvmlError(Exception):
+    def __init__(self, func, code, msg=''):
+        self.code = code
+        super().__init__('{} failed with code {} {}'.format(func, code, msg).strip())
+
+
+class NvmlUtilization(ctypes.Structure):
+    _fields_ = [('gpu', ctypes.c_uint), ('memory', ctypes.c_uint)]
+
+
+class NvmlMemory(ctypes.Structure):
+    _fields_ = [('total', ctypes.c_ulonglong), ('free', ctypes.c_ulonglong), ('used', ctypes.c_ulonglong)]
+
+
+class NvmlPciInfo(ctypes.Structure):
+    _fields_ = [
+        ('busIdLegacy', ctypes.c_char * 16), ('domain', ctypes.c_uint), ('bus', ctypes.c_uint),
+        ('device', ctypes.c_uint), ('pciDeviceId', ctypes.c_uint), ('pciSubSystemId', ctypes.c_uint),
+        ('busId', ctypes.c_char * 32),
+    ]
+
+
+class NvmlGpu(NvidiaGpu):
+    """
+    Reads telemetry in-process from libnvidia-ml through ctypes.
+    Device handles and static card info are read once, get_data() only
+    queries the counters which change.
+    """
+    def __init__(self, lib_name=args.nvml_lib):
+        super().__init__()
+        self.lib = ctypes.CDLL(lib_name)
+        self.handles = []
+        self.static_data = []
+
+        self.call('nvmlInit_v2', 'nvmlInit')
+        driver_version = self.read_string(None, 'nvmlSystemGetDriverVersion')
+
+        count = ctypes.c_uint()
+        self.call('nvmlDeviceGetCount_v2', 'nvmlDeviceGetCount', args=(ctypes.byref(count), ))
+
+        for index in range(count.value):
+            handle = ctypes.c_void_p()
+            self.call('nvmlDeviceGetHandleByIndex_v2', 'nvmlDeviceGetHandleByIndex', args=(index, ctypes.byref(handle)))
+
+            pci = NvmlPciInfo()
+            self.call('nvmlDeviceGetPciInfo_v3', 'nvmlDeviceGetPciInfo_v2', args=(handle, ctypes.byref(pci)))
+            mem = NvmlMemory()
+            self.call('nvmlDeviceGetMemoryInfo', args=(handle, ctypes.byref(mem)))
+
+            d = dict.fromkeys(self.cards_keys)
+            d.update(dict(
+                index=index,
+                card_model=self.read_string(handle, 'nvmlDeviceGetName'),
+                uuid=self.read_string(handle, 'nvmlDeviceGetUUID'),
+                driver_version=driver_version,
+                bus_id='{:08X}:{:02X}:{:02X}.0'.format(pci.domain, pci.bus, pci.device),
+                mem_total=mem.total // 2 ** 20,
+                vbios_version=self.read_string(handle, 'nvmlDeviceGetVbiosVersion'),
+                name='card{0:02d}'.format(index),
+                vendor=GPU_TYPE[1],
+            ))
+            self.handles.append(handle)
+            self.static_data.append(d)
+        log.info('NVML initialized, {} cards found'.format(len(self.handles)))
+
+    def call(self, *func_names, args=()):
+        for func_name in func_names:
+            func = getattr(self.lib, func_name, None)
+            if func is not None:
+                break
+        else:
+            raise NvmlError(func_names[0], -1, 'not found in library')
+
+        code = func(*args)
+        if code != NVML_SUCCESS:
+            raise NvmlError(func_name, code)
+
+    def read_string(self, handle, func_name, size=96):
+        buf = ctypes.create_string_buffer(size)
+        func_args = (buf, ctypes.c_uint(size)) if handle is None else (handle, buf, ctypes.c_uint(size))
+        self.call(func_name, args=func_args)
+        return buf.value.decode('utf-8')
+
+    def read_uint(self, handle, func_name, *func_args):
+        value = ctypes.c_uint()
+        try:
+            self.call(func_name, args=(handle, ) + func_args + (ctypes.byref(value), ))
+        except NvmlError as e:
+            if e.code != NVML_ERROR_NOT_SUPPORTED:
+                raise
+            log.debug(e)
+        return value.value
+
+    def get_data(self):
+        cards_data = []
 
-                index = int(index)
+        for handle, static in zip(self.handles, self.static_data):
+            util = NvmlUtilization()
+            mem = NvmlMemory()
+            d = dict(static)
+
+            try:
+                self.call('nvmlDeviceGetUtilizationRates', args=(handle, ctypes.byref(util)))
+                self.call('nvmlDeviceGetMemoryInfo', args=(handle, ctypes.byref(mem)))
                 d.update(dict(
-                    index=index,
-                    name='card{0:02d}'.format(index),
-                    temp=int(d.get('temp')),
-                    power_current=round(float(d.get('power_current'))),
-                    mem_load=int(d.get('mem_load')),
-                    core_load=int(d.get('core_load')),
-                    core_clock=int(d.get('core_clock')),
-                    mem_used=int(d.get('mem_used')),
-                    mem_total=int(d.get('mem_total')),
-                    mem_clock=int(d.get('mem_clock')),
-                    fan=int(d.get('fan')),
-                    vendor=GPU_TYPE[1],
+                    pcie_gen=str(self.read_uint(handle, 'nvmlDeviceGetCurrPcieLinkGeneration')),
+                    core_load=util.gpu,
+                    temp=self.read_uint(handle, 'nvmlDeviceGetTemperature', NVML_TEMPERATURE_GPU),
+                    fan=self.read_uint(handle, 'nvmlDeviceGetFanSpeed'),
+                    power_current=round(self.read_uint(handle, 'nvmlDeviceGetPowerUsage') / 1000),
+                    core_clock=self.read_uint(handle, 'nvmlDeviceGetClockInfo', NVML_CLOCK_SM),
+                    mem_clock=self.read_uint(handle, 'nvmlDeviceGetClockInfo', NVML_CLOCK_MEM),
+                    mem_load=util.memory,
+                    mem_used=mem.used // 2 ** 20,
                 ))
+            except NvmlError as e:
+                log.error('Error reading {}: {}'.format(d.get('name'), e))
+                continue
+            cards_data.append(d)
 
-                self.cards_data.append(d)
+        self.cards_data = cards_data
+        self.last_ts = datetime.datetime.now()
         log.debug(self.cards_data)
         return self.cards_data
 
 
 class AmdGpu():
+    """
+    Tested on AMDGPU-PRO driver
+
+    Cards are discovered once and again on drm uevents (or every
+    `rescan_interval` seconds if the uevent socket is not available).
+    sysfs files stay open and are re-read with os.pread.
+    """
     def __init__(self):
+        self.cards = []
         self.cards_data = []
         self.last_ts = datetime.datetime.now()
         self.cards_keys = ('name', 'temp_path', 'pwm_path', 'temp', 'pwm', 'fan')
         self.sysfs_path = '/sys/class/drm/'
         self.sysfs_temp = 'temp1_input'
         self.sysfs_pwm = 'pwm1'
-        self.card_path_tpl = '/sys/class/drm/card{card_id}/device/hwmon/hwmon{hw}/{data_type}'
+        self.card_regex = re.compile(r'^card(?P<card_id>[\d]+)$')
+        self.hwmon_path_tpl = '/sys/class/drm/card{card_id}/device/hwmon'
         self.card_kernel_path_tpl = '/sys/kernel/debug/dri/{card_id}/amdgpu_pm_info'
 
-    def get_data(self):
-        """
-        Tested on AMDGPU-PRO driver
-        """
-        import re
-        import os
+        self.rescan_interval = 60
+        self.rescan_ts = 0
+        self.uevent_sock = self.open_uevent_socket()
 
-        card_id_list = []
-        self.last_ts = datetime.datetime.now()
+    def open_uevent_socket(self):
+        if args.fake:
+            return None
+
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+            sock.setblocking(False)
+        except (AttributeError, OSError) as e:
+            log.warning('udev events are not available ({}), rescanning cards every {} seconds'.format(e, self.rescan_interval))
+            return None
+        return sock
 
+    def need_rescan(self):
+        if not self.rescan_ts:
+            return True
 
-        regex = r'^card(?P<card_id>[\d]+)$'
+        if self.uevent_sock is None:
+            return time.monotonic() - self.rescan_ts > self.rescan_interval
 
+        changed = False
+        while True:
+            try:
+                msg = self.uevent_sock.recv(65536)
+            except BlockingIOError:
+                return changed
+            except OSError as e:
+                log.error('Error reading udev events: {}'.format(e))
+                return True
+            if b'SUBSYSTEM=drm' in msg:
+                changed = True
+
+    def list_cards(self):
         if args.fake:
-            card_list = (
+            return (
                 'card3-HDMI-A-5', 'card3-HDMI-A-6', 'card4', 'card4-DP-11', 'card4-DP-12',
                 'card4-DP-13', 'card4-DVI-D-5', 'card4-HDMI-A-7', 'card5', 'card5-DP-14',
                 'card5-DP-15', 'card5-DP-16', 'card5-DVI-D-6', 'card5-HDMI-A-8', 'card6',
@@ -158,106 +480,399 @@ class AmdGpu():
                 'card10-HDMI-A-10', 'card10-HDMI-A-3', 'card10', 'card10-DP-6', 'card10-DP-7',
                 'renderD131', 'renderD132', 'renderD133', 'renderD134', 'renderD135', 'version',
             )
-        else:
-            try:
-                card_list = [x for x in os.listdir(self.sysfs_path) if 'card' in x]
-            except FileNotFoundError:
-                log.error('Error reading \"{}\"'.format(self.sysfs_path))
-                card_list = []
 
-        for card in sorted(card_list):
-            m = re.match(regex, card)
+        try:
+            return os.listdir(self.sysfs_path)
+        except FileNotFoundError:
+            log.error('Error reading \"{}\"'.format(self.sysfs_path))
+            return []
+
+    def find_hwmon(self, card_id):
+        """
+        hwmon index does not follow the card index, look for the
+        directory which has the temperature input
+        """
+        hwmon_path = self.hwmon_path_tpl.format(card_id=card_id)
+
+        if args.fake:
+            return os.path.join(hwmon_path, 'hwmon{}'.format(card_id + 1))
+
+        try:
+            hwmon_list = sorted(os.listdir(hwmon_path))
+        except OSError:
+            return None
+
+        for hwmon in hwmon_list:
+            path = os.path.join(hwmon_path, hwmon)
+            if os.path.isfile(os.path.join(path, self.sysfs_temp)):
+                return path
+        return None
+
+    def open_file(self, path):
+        if args.fake:
+            return None
+        return os.open(path, os.O_RDONLY)
+
+    def close_card(self, card):
+        for fd in (card['temp_fd'], card['pwm_fd'], card['pm_fd']):
+            if fd is not None:
+                os.close(fd)
+
+    def close_cards(self):
+        for card in self.cards:
+            self.close_card(card)
+        self.cards = []
+
+    def discover(self):
+        self.close_cards()
+        self.rescan_ts = time.monotonic()
+
+        card_id_list = []
+        for card in self.list_cards():
+            m = self.card_regex.match(card)
             if m:
-                card_id = int(m.group('card_id'))
-                card_id_list.append(card_id)
+                card_id_list.append(int(m.group('card_id')))
 
-        card_id_list.sort()
+        for card_id in sorted(card_id_list):
+            hwmon = self.find_hwmon(card_id)
+            if hwmon is None:
+                log.error('hwmon not found for card{}'.format(card_id))
+                continue
 
-        card_names = ['card{0:02d}'.format(x) for x in card_id_list]
-        temp_path_list = [self.card_path_tpl.format(card_id=x, hw=x + 1, data_type=self.sysfs_temp) for x in card_id_list]
-        temp_values = self.read_data(temp_path_list)
+            card = dict(
+                card_id=card_id,
+                name='card{0:02d}'.format(card_id),
+                temp_path=os.path.join(hwmon, self.sysfs_temp),
+                pwm_path=os.path.join(hwmon, self.sysfs_pwm),
+                temp_fd=None,
+                pwm_fd=None,
+                pm_fd=None,
+            )
+            try:
+                card['temp_fd'] = self.open_file(card['temp_path'])
+                card['pwm_fd'] = self.open_file(card['pwm_path'])
+            except OSError as e:
+                log.error('Error opening sysfs files of {}: {}'.format(card['name'], e))
+                self.close_card(card)
+                continue
+
+            pm_path = self.card_kernel_path_tpl.format(card_id=card_id)
+            try:
+                card['pm_fd'] = self.open_file(pm_path)
+            except OSError:
+                log.error('Error reading \"{}\". Maybe need root access'.format(pm_path))
+            self.cards.append(card)
+
+        log.info('AMD cards found: {}'.format(', '.join(x['name'] for x in self.cards)))
+
+    def get_data(self):
+        self.last_ts = datetime.datetime.now()
 
-        pwm_path_list = [self.card_path_tpl.format(card_id=x, hw=x + 1, data_type=self.sysfs_pwm) for x in card_id_list]
-        pwm_values = self.read_data(pwm_path_list)
-        fan_values = [self.pwm2fan(x) for x in pwm_values]
+        if self.need_rescan():
+            self.discover()
 
-        kernel_values = self.read_kernel_data(card_id_list)
+        cards_data = []
+        for card in self.cards:
+            try:
+                temp = round(self.read_int(card['temp_fd'], fake_max=75000) / 1000)
+                pwm = self.read_int(card['pwm_fd'], fake_max=255)
+                kernel_data = self.read_kernel_data(card['pm_fd'])
+            except (OSError, ValueError) as e:
+                log.error('Error reading {}: {}'.format(card['name'], e))
+                self.rescan_ts = 0
+                continue
 
-        for idx, i in enumerate(zip(card_names, temp_path_list, pwm_path_list, temp_values, pwm_values, fan_values)):
-            d = dict(zip(self.cards_keys, i))
+            d = dict(zip(self.cards_keys, (card['name'], card['temp_path'], card['pwm_path'], temp, pwm, self.pwm2fan(pwm))))
             d['vendor'] = GPU_TYPE[0]
-            d.update(kernel_values[idx])
-            self.cards_data.append(d)
+            d.update(kernel_data)
+            cards_data.append(d)
 
+        self.cards_data = cards_data
         log.debug(self.cards_data)
         return self.cards_data
 
     def pwm2fan(self, pwm):
         return round(int(pwm) / (255 / 100))
 
-    def read_data(self, path_list):
+    def read_int(self, fd, fake_max):
+        if args.fake:
+            return random.randint(fake_max // 4, fake_max)
+        return int(os.pread(fd, 32, 0))
+
+    def read_kernel_data(self, fd):
+        d = dict()
+
+        if fd is None:
+            return d
+
+        for i in os.pread(fd, 8192, 0).decode('utf-8').splitlines():
+            if 'GPU Load:' in i:
+                d['core_load'] = int(i.split()[2])
+            if '(average GPU)' in i:
+                d['power_current'] = round(float(i.split()[0]))
+            if '(MCLK)' in i:
+                d['mem_clock'] = int(i.split()[0])
+            if '(SCLK)' in i:
+                d['core_clock'] = int(i.split()[0])
+            if '(max GPU)' in i:
+                d['power_max'] = round(float(i.split()[0]))
+        return d
+
+
+def make_gpu_data():
+    if args.gpu_type == GPU_TYPE[0]:
+        return AmdGpu()
+
+    if args.nvidia_backend == NVIDIA_BACKEND[1]:
+        return NvidiaGpuStream()
+    elif args.nvidia_backend == NVIDIA_BACKEND[2]:
+        try:
+            return NvmlGpu(args.nvml_lib)
+        except (OSError, NvmlError) as e:
+            log.error('NVML is not available ({}), using nvidia-smi'.format(e))
+    return NvidiaGpu()
+
+
+gpu_data = make_gpu_data()
+
+
+def date2json(d):
+    return d.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class HistoryTier():
+    """
+    Fixed size ring of min/avg/max buckets, `step` seconds each
+    """
+    def __init__(self, step, size):
+        self.step = step
+        self.size = size
+        self.head = -1
+        self.count = 0
+        self.ts = array('q', [0]) * size
+        self.min = array('f', [0]) * size
+        self.max = array('f', [0]) * size
+        self.sum = array('d', [0]) * size
+        self.samples = array('I', [0]) * size
+
+    def add(self, ts, value):
+        bucket = int(ts) // self.step * self.step
+        idx = self.head
+
+        if idx >= 0 and bucket <= self.ts[idx]:
+            if bucket < self.ts[idx]:
+                return  # wall clock went back
+            self.min[idx] = min(self.min[idx], value)
+            self.max[idx] = max(self.max[idx], value)
+            self.sum[idx] += value
+            self.samples[idx] += 1
+            return
+
+        idx = (idx + 1) % self.size
+        self.head = idx
+        self.count = min(self.count + 1, self.size)
+        self.ts[idx] = bucket
+        self.min[idx] = self.max[idx] = self.sum[idx] = value
+        self.samples[idx] = 1
+
+    def points(self, since=0):
         res = []
 
-        for path in path_list:
-            if not args.fake:
-                with open(path, 'r') as f:
-                    try:
-                        data = int(f.read().rstrip())
-                        if self.sysfs_temp in path:
-                            data = round(data / 1000)
-                        res.append(data)
-                    except:
-                        log.error('Error reading \"{}\"'.format(path))
-            else:
-                if self.sysfs_temp in path:
-                    fake_data = random.randint(20, 75)
-                else:
-                    fake_data = random.randint(0, 255)
-                res.append(fake_data)
+        for i in range(self.head - self.count + 1, self.head + 1):
+            idx = i % self.size
+            if self.ts[idx] < since:
+                continue
+            avg = self.sum[idx] / self.samples[idx]
+            res.append([self.ts[idx], round(self.min[idx], 2), round(avg, 2), round(self.max[idx], 2)])
         return res
 
-    def read_kernel_data(self, id_list):
+
+class History():
+    """
+    Per card and per metric time series with bounded memory.
+    Every sample is added to all tiers, coarser tiers keep a longer window.
+    """
+    def __init__(self, metrics=HISTORY_METRICS, tiers=HISTORY_TIERS):
+        self.metrics = metrics
+        self.tiers = tiers
+        self.cards = {}
+        self.aliases = {}
+        self.lock = threading.Lock()
+
+    def add(self, ts, cards):
+        with self.lock:
+            for card in cards:
+                name = card.get('name')
+                series = self.cards.get(name)
+                if series is None:
+                    series = {x: [HistoryTier(step, size) for step, size in self.tiers] for x in self.metrics}
+                    self.cards[name] = series
+
+                for alias in (card.get('bus_id'), card.get('uuid'), card.get('index')):
+                    if alias is not None:
+                        self.aliases[str(alias)] = name
+
+                for metric, tiers in series.items():
+                    value = card.get(metric)
+                    if isinstance(value, (int, float)):
+                        for tier in tiers:
+                            tier.add(ts, value)
+
+    def query(self, card, metric, since=0, step=0):
+        """
+        Finest tier which covers the window from `since` (unix time) to now
+        and has buckets of at least `step` seconds
+        """
+        name = self.aliases.get(card, card)
+        series = self.cards.get(name)
+        if series is None:
+            return None
+
+        window = time.time() - since if since else 0
+        tiers = series[metric]
+        tier = next((x for x in tiers if x.step >= step and x.step * x.size >= window), tiers[-1])
+        with self.lock:
+            points = tier.points(since)
+        return dict(card=name, metric=metric, step=tier.step, points=points)
+
+
+HISTORY = History()
+
+
+class ApiSnapshot(CachedBody):
+    """
+    API data serialized once per refresh. Request handlers only write
+    the prepared bytes.
+    """
+    def __init__(self, data, prev=None):
+        super().__init__(json.dumps(data).encode('utf-8'))
+        self.data = data
+        self.seq = prev.seq + 1 if prev else 1
+        self.ts = time.time()
+
+        self.metrics = self.render_metrics(data[0]['cards']).encode('utf-8')
+        self.render_columnar(data[0]['cards'])
+
+        self.sse_snapshot = self.sse_event('snapshot', self.body)
+        delta = self.get_delta(prev.data[0]['cards'] if prev else [], data[0]['cards'])
+        self.sse_delta = self.sse_event('delta', json.dumps(delta).encode('utf-8'))
+
+    def render_metrics(self, cards):
+        """
+        Prometheus text exposition format, one gauge family per card metric
+        """
         res = []
+        labels = [
+            ','.join('{}="{}"'.format(k, prometheus_escape(card.get(k, ''))) for k in PROMETHEUS_LABELS)
+            for card in cards
+        ]
 
-        for cid in id_list:
-            path = self.card_kernel_path_tpl.format(card_id=cid)
-            d = dict()
-
-            if os.path.exists(path) and os.path.isfile(path):
-                with open(path, 'r') as f:
-                    for i in f.readlines():
-                        if 'GPU Load:' in i:
-                            d['core_load'] = int(i.split(' ')[2])
-                        if '(average GPU)' in i:
-                            d['power_current'] = round(float(i.split()[0]))
-                        if '(MCLK)' in i:
-                            d['mem_clock'] = int(i.split()[0])
-                        if '(SCLK)' in i:
-                            d['core_clock'] = int(i.split()[0])
-                        if '(max GPU)' in i:
-                            d['power_max'] = round(float(i.split()[0]))
-                log.debug(path)
-                res.append(d)
-            else:
-                log.error('Error reading \"{}\". Maybe need root access'.format(path))
-        log.debug(res)
-        return res
+        for key, metric, help_text in PROMETHEUS_METRICS:
+            samples = [
+                '{}{{{}}} {}'.format(metric, card_labels, card[key])
+                for card, card_labels in zip(cards, labels)
+                if isinstance(card.get(key), (int, float))
+            ]
+            if samples:
+                res.append('# HELP {} {}'.format(metric, help_text))
+                res.append('# TYPE {} gauge'.format(metric))
+                res.extend(samples)
 
+        res.append('# HELP rig_api_data_timestamp_seconds Time of the last collected data')
+        res.append('# TYPE rig_api_data_timestamp_seconds gauge')
+        res.append('rig_api_data_timestamp_seconds {}'.format(self.ts))
+        return '\n'.join(res) + '\n'
 
-if args.gpu_type == GPU_TYPE[0]:
-    gpu_data = AmdGpu()
-elif args.gpu_type == GPU_TYPE[1]:
-    gpu_data = NvidiaGpu()
+    def render_columnar(self, cards):
+        """
+        Compact formats: static card info is sent only to clients which do not
+        know the current schema id, metrics go as one array per metric.
+        """
+        static = dict(
+            fields=COLUMNAR_STATIC,
+            cards=[[card.get(k) for k in COLUMNAR_STATIC] for card in cards],
+            metrics=COLUMNAR_METRICS,
+        )
+        static_body = json.dumps(static).encode('utf-8')
+        self.schema = zlib.crc32(static_body)
 
+        metrics = {
+            k: [card[k] if isinstance(card.get(k), (int, float)) else None for card in cards]
+            for k in COLUMNAR_METRICS
+        }
+        columnar = dict(version=COLUMNAR_VERSION, schema='{:08x}'.format(self.schema), ts=self.ts, metrics=metrics)
+        self.columnar = json.dumps(columnar).encode('utf-8')
+        columnar['static'] = static
+        self.columnar_static = json.dumps(columnar).encode('utf-8')
 
-def date2json(d):
-    return d.strftime('%Y-%m-%d %H:%M:%S')
+        values = [BINARY_MISSING if x is None else int(x) for k in COLUMNAR_METRICS for x in metrics[k]]
+        packed = struct.pack('<{}i'.format(len(values)), *values)
+        header = (BINARY_MAGIC, COLUMNAR_VERSION, 0, self.schema, self.ts, len(cards), len(COLUMNAR_METRICS))
+        self.binary = BINARY_HEADER.pack(*header) + packed
+        self.binary_static = (
+            BINARY_HEADER.pack(*header[:2] + (1, ) + header[3:]) +
+            struct.pack('<I', len(static_body)) + static_body + packed
+        )
+
+    def sse_event(self, event, body):
+        return 'id: {}\nevent: {}\ndata: '.format(self.seq, event).encode('utf-8') + body + b'\n\n'
+
+    def get_delta(self, prev_cards, cards):
+        """
+        Changed fields per card name compared to the previous snapshot
+        """
+        prev_d = {x.get('name'): x for x in prev_cards}
+        changed = {}
+
+        for card in cards:
+            name = card.get('name')
+            prev_card = prev_d.pop(name, {})
+            fields = {k: v for k, v in card.items() if prev_card.get(k) != v}
+            if fields:
+                changed[name] = fields
+
+        return dict(ts=self.ts, cards=changed, removed=sorted(prev_d))
 
 
-def get_api_data(read_interval=args.getdata_interval):
-    global API_DATA
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def count_request(path):
+    if path not in API_ROUTES:
+        path = 'other'
+    with REQUEST_LOCK:
+        REQUEST_COUNT[path] = REQUEST_COUNT.get(path, 0) + 1
+
+
+def render_server_metrics():
+    res = [
+        '# HELP rig_api_collect_duration_seconds Duration of the last data collection',
+        '# TYPE rig_api_collect_duration_seconds gauge',
+        'rig_api_collect_duration_seconds {}'.format(collector.duration),
+        '# HELP rig_api_collect_total Data collections',
+        '# TYPE rig_api_collect_total counter',
+        'rig_api_collect_total {}'.format(collector.collect_count),
+        '# HELP rig_api_collect_skipped_total Collector ticks skipped because collection was too slow',
+        '# TYPE rig_api_collect_skipped_total counter',
+        'rig_api_collect_skipped_total {}'.format(collector.skip_count),
+        '# HELP rig_api_requests_total HTTP requests by path',
+        '# TYPE rig_api_requests_total counter',
+    ]
+    with REQUEST_LOCK:
+        res.extend('rig_api_requests_total{{path="{}"}} {}'.format(k, v) for k, v in sorted(REQUEST_COUNT.items()))
+    return ('\n'.join(res) + '\n').encode('utf-8')
+
+
+def wait_snapshot(check, timeout):
+    with SNAPSHOT_COND:
+        SNAPSHOT_COND.wait_for(lambda: API_SNAPSHOT is not None and check(API_SNAPSHOT), timeout)
+        return API_SNAPSHOT
+
+
+def get_api_data():
+    global API_DATA, API_SNAPSHOT
 
-    threading.Timer(read_interval, get_api_data).start()
     log.debug('Updating API data...')
 
     API_DATA = [
@@ -270,33 +885,214 @@ def get_api_data(read_interval=args.getdata_interval):
     if args.fake:
         API_DATA.append(dict(fake=True))
     log.debug(API_DATA)
+    HISTORY.add(time.time(), API_DATA[0]['cards'])
+
+    try:
+        snapshot = ApiSnapshot(API_DATA, prev=API_SNAPSHOT)
+    except (TypeError, ValueError) as e:
+        log.error('Error serializing API data: {}'.format(e))
+        return
+
+    with SNAPSHOT_COND:
+        API_SNAPSHOT = snapshot
+        SNAPSHOT_COND.notify_all()
+
+    for hook in SNAPSHOT_HOOKS:
+        hook()
+
+
+class Collector(threading.Thread):
+    """
+    Single thread refreshing API data on time.monotonic() deadlines.
+    If a collection overruns the interval the missed ticks are skipped.
+    """
+    def __init__(self, interval=args.getdata_interval):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.duration = 0
+        self.collect_count = 0
+        self.skip_count = 0
+
+    def collect(self):
+        start = time.monotonic()
+        try:
+            get_api_data()
+        except Exception as e:
+            log.exception('Error updating API data: {}'.format(e))
+        self.duration = time.monotonic() - start
+        self.collect_count += 1
+        log.debug('API data collected in {:.3f} seconds'.format(self.duration))
+
+    def run(self):
+        deadline = time.monotonic() + self.interval
+
+        while True:
+            now = time.monotonic()
+            if deadline > now:
+                time.sleep(deadline - now)
+
+            self.collect()
+
+            deadline += self.interval
+            now = time.monotonic()
+            if now >= deadline:
+                missed = int((now - deadline) // self.interval) + 1
+                self.skip_count += missed
+                deadline += missed * self.interval
+                log.warning('Collecting took {:.3f} seconds, {} ticks skipped'.format(self.duration, missed))
+
+
+def html_response(http_code, html):
+    return http_code, [('Content-Type', 'text/html')], html.encode('utf-8')
+
+
+def json_response(http_code, data):
+    headers = [('Content-type', 'application/json'), ('Access-Control-Allow-Origin', '*')]
+    return http_code, headers, json.dumps(data).encode('utf-8')
+
+
+def snapshot_response(snapshot, request_headers):
+    if snapshot is None:
+        return html_response(503, '<h1>No data yet</h1>')
+
+    return cached_response(snapshot, request_headers, [
+        ('X-Snapshot-Ts', str(snapshot.ts)),
+        ('Access-Control-Allow-Origin', '*'),
+    ])
+
+
+def history_response(query):
+    card = query.get('card', [''])[0]
+    metric = query.get('metric', [''])[0]
+
+    if metric not in HISTORY_METRICS:
+        return json_response(400, dict(error='Unknown metric \"{}\"'.format(metric), metrics=HISTORY_METRICS))
+
+    try:
+        since = float(query.get('since', [0])[0])
+        step = int(query.get('step', [0])[0])
+    except ValueError:
+        return json_response(400, dict(error='since and step must be numbers'))
+
+    res = HISTORY.query(card, metric, since=since, step=step)
+    if res is None:
+        return json_response(404, dict(error='Unknown card \"{}\"'.format(card), cards=sorted(HISTORY.cards)))
+    return json_response(200, res)
+
+
+def columnar_response(snapshot, query):
+    """
+    ?format=columnar (JSON) or ?format=binary. Pass the schema id from the
+    previous response as ?schema= to skip the static card info.
+    """
+    if snapshot is None:
+        return html_response(503, '<h1>No data yet</h1>')
+
+    known = query.get('schema', [''])[0] == '{:08x}'.format(snapshot.schema)
+    if query['format'][0] == 'columnar':
+        headers = [('Content-type', 'application/json'), ('Access-Control-Allow-Origin', '*')]
+        return 200, headers, snapshot.columnar if known else snapshot.columnar_static
+    return 200, [('Content-type', 'application/octet-stream')], snapshot.binary if known else snapshot.binary_static
+
+
+def metrics_response(snapshot):
+    body = render_server_metrics()
+    if snapshot is not None:
+        body = snapshot.metrics + body
+    return 200, [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')], body
+
+
+def get_wait_for_ts(path, query):
+    if path != '/api/v1' or 'wait_for_ts' not in query:
+        return None
+    try:
+        return float(query['wait_for_ts'][0])
+    except ValueError:
+        return None
+
+
+def route(path, query, request_headers, snapshot):
+    """
+    Response for every route except the event stream. Servers pass in the
+    snapshot, for long-poll requests it is the one they waited for.
+    """
+    if path == '/api/v1':
+        if 'wait_for_ts' in query and get_wait_for_ts(path, query) is None:
+            return json_response(400, dict(error='wait_for_ts must be a number'))
+        fmt = query.get('format', ['json'])[0]
+        if fmt in ('columnar', 'binary'):
+            return columnar_response(snapshot, query)
+        elif fmt != 'json':
+            return json_response(400, dict(error='Unknown format \"{}\"'.format(fmt), formats=('json', 'columnar', 'binary')))
+        return snapshot_response(snapshot, request_headers)
+    elif path == '/api/v1/history':
+        return history_response(query)
+    elif path == '/metrics':
+        return metrics_response(snapshot)
+    return html_response(200, '<h1>It works!</h1>')
+
+
+STREAM_HEADERS = [
+    ('Content-Type', 'text/event-stream'),
+    ('Cache-Control', 'no-cache'),
+    ('Access-Control-Allow-Origin', '*'),
+]
+
+
+def stream_event(snapshot, seq, use_delta):
+    """
+    Next Server-Sent Event for a client which has seen snapshot `seq`.
+    Full snapshot on connect and after missed refreshes, delta otherwise.
+    """
+    if snapshot is None or snapshot.seq == seq:
+        return b': keepalive\n\n', seq
+    if use_delta and seq and snapshot.seq == seq + 1:
+        return snapshot.sse_delta, snapshot.seq
+    return snapshot.sse_snapshot, snapshot.seq
 
 
 class HttpRequestHandler(BaseHTTPRequestHandler):
-    def _send_html(self, http_code, html):
+    def _send_response(self, http_code, headers, body):
         self.send_response(http_code)
-        self.send_header('Content-Type', 'text/html')
+        for k, v in headers:
+            self.send_header(k, v)
+        if http_code != 304:
+            self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        self.wfile.write(body)
 
-    def _send_json(self, data):
-        try:
-            res = json.dumps(data)
-        except:
-            self.send_response(500)
-            return
+    def _send_stream(self, query):
+        use_delta = query.get('delta', ['0'])[0] not in ('', '0')
+        seq = 0
 
         self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
+        for k, v in STREAM_HEADERS:
+            self.send_header(k, v)
         self.end_headers()
-        self.wfile.write(res.encode('utf-8'))
+
+        try:
+            while True:
+                snapshot = wait_snapshot(lambda x: x.seq != seq, SSE_KEEPALIVE)
+                event, seq = stream_event(snapshot, seq, use_delta)
+                self.wfile.write(event)
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug('Stream client {} disconnected'.format(self.client_address[0]))
 
     def do_GET(self):
-        if self.path == '/api/v1':
-            self._send_json(API_DATA)
-        else:
-            self._send_html(200, '<h1>It works!</h1>')
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        count_request(url.path)
+
+        if url.path == '/api/v1/stream':
+            self._send_stream(query)
+            return
+
+        snapshot = API_SNAPSHOT
+        wait_for_ts = get_wait_for_ts(url.path, query)
+        if wait_for_ts is not None:
+            snapshot = wait_snapshot(lambda x: x.ts > wait_for_ts, args.long_poll_timeout)
+
+        self._send_response(*route(url.path, query, self.headers, snapshot))
 
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
@@ -305,16 +1101,194 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
         self.daemon_threads = True
 
 
-if args.api:
-    log.info('Starting server ...')
-    get_api_data()
-    log.info('Server listening on port 8000...')
-    httpd = ThreadedHTTPServer(('0.0.0.0', 8000), HttpRequestHandler)
-    httpd.serve_forever()
-else:
-    if args.gpu_type == GPU_TYPE[0]:
-        a = AmdGpu()
-        a.get_data()
-    elif args.gpu_type == GPU_TYPE[1]:
-        n = NvidiaGpu()
-        n.get_data()
+class AsyncHttpServer():
+    """
+    HTTP/1.1 server on asyncio. Connections are kept alive and pipelined
+    requests are answered in order, all from the shared snapshot.
+    """
+    def __init__(self, host, port, max_connections=args.max_connections, keepalive_timeout=args.keepalive_timeout):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.max_headers = 100
+        self.connections = 0
+        self.loop = None
+        self.snapshot_event = None
+
+    def notify(self):
+        """
+        Called from the collector thread after every new snapshot
+        """
+        self.loop.call_soon_threadsafe(self.wake_up)
+
+    def wake_up(self):
+        self.snapshot_event.set()
+        self.snapshot_event = asyncio.Event()
+
+    async def wait_snapshot(self, check, timeout):
+        deadline = self.loop.time() + timeout
+
+        while API_SNAPSHOT is None or not check(API_SNAPSHOT):
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.snapshot_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return API_SNAPSHOT
+
+    def render(self, http_code, headers, body, keep_alive):
+        lines = ['HTTP/1.1 {} {}'.format(http_code, HTTPStatus(http_code).phrase)]
+        lines.extend('{}: {}'.format(k, v) for k, v in headers)
+        if body is not None:
+            lines.append('Content-Length: {}'.format(len(body)))
+        lines.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+
+    async def read_request(self, reader):
+        request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+        if not request_line:
+            return None
+
+        raw_headers = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            raw_headers.append(line)
+            if len(raw_headers) > self.max_headers:
+                raise ValueError('Too many headers')
+
+        method, target, version = request_line.decode('latin-1').split()
+        headers = http.client.parse_headers(io.BytesIO(b''.join(raw_headers) + b'\r\n'))
+
+        length = int(headers.get('Content-Length', 0))
+        if length:
+            await reader.readexactly(length)
+        return method, target, version, headers
+
+    async def send_stream(self, writer, query):
+        use_delta = query.get('delta', ['0'])[0] not in ('', '0')
+        seq = 0
+
+        writer.write(self.render(200, STREAM_HEADERS, None, keep_alive=False))
+        while True:
+            snapshot = await self.wait_snapshot(lambda x: x.seq != seq, SSE_KEEPALIVE)
+            event, seq = stream_event(snapshot, seq, use_delta)
+            writer.write(event)
+            await writer.drain()
+
+    async def handle(self, reader, writer):
+        if self.connections >= self.max_connections:
+            writer.write(self.render(*html_response(503, '<h1>Too many connections</h1>'), keep_alive=False))
+            writer.close()
+            return
+
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError:
+                    writer.write(self.render(*html_response(400, '<h1>Bad request</h1>'), keep_alive=False))
+                    break
+                if request is None:
+                    break
+
+                method, target, version, headers = request
+                connection = headers.get('Connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+
+                if method != 'GET':
+                    writer.write(self.render(*html_response(405, '<h1>Method not allowed</h1>'), keep_alive=keep_alive))
+                    await writer.drain()
+                    if not keep_alive:
+                        break
+                    continue
+
+                url = urlparse(target)
+                query = parse_qs(url.query)
+                count_request(url.path)
+
+                if url.path == '/api/v1/stream':
+                    await self.send_stream(writer, query)
+                    break
+
+                snapshot = API_SNAPSHOT
+                wait_for_ts = get_wait_for_ts(url.path, query)
+                if wait_for_ts is not None:
+                    snapshot = await self.wait_snapshot(lambda x: x.ts > wait_for_ts, args.long_poll_timeout)
+
+                http_code, res_headers, body = route(url.path, query, headers, snapshot)
+                writer.write(self.render(http_code, res_headers, body if http_code != 304 else None, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            log.debug('Client disconnected')
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.snapshot_event = asyncio.Event()
+        SNAPSHOT_HOOKS.append(self.notify)
+
+        server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+
+TELEMETRY_LAST = None
+
+
+def publish_telemetry():
+    """
+    Stamps the file with the time the backend sampled the data, not the
+    publish time. An unchanged snapshot is not published again, so readers
+    see the telemetry age and fall back when the backend is stuck.
+    """
+    global TELEMETRY_LAST
+
+    cards = API_DATA[0]['cards']
+    if (gpu_data.last_ts, cards) == TELEMETRY_LAST:
+        return
+
+    age = max((datetime.datetime.now() - gpu_data.last_ts).total_seconds(), 0)
+    try:
+        TELEMETRY.publish(cards, ts=time.time() - age, mono_ts=time.monotonic() - age)
+    except (OSError, ValueError, struct.error) as e:
+        log.error('Error writing telemetry to \"{}\": {}'.format(args.shm_path, e))
+        return
+    TELEMETRY_LAST = (gpu_data.last_ts, list(cards))
+
+
+if __name__ == '__main__':
+    if args.api:
+        log.info('Starting server ...')
+        if args.shm_path:
+            try:
+                TELEMETRY = TelemetryWriter(args.shm_path)
+            except OSError as e:
+                log.error('Shared memory telemetry is disabled: {}'.format(e))
+            else:
+                SNAPSHOT_HOOKS.append(publish_telemetry)
+        collector = Collector()
+        collector.collect()
+        collector.start()
+        log.info('Server listening on port 8000...')
+        if args.server == SERVER_TYPE[1]:
+            httpd = AsyncHttpServer('0.0.0.0', 8000)
+        else:
+            httpd = ThreadedHTTPServer(('0.0.0.0', 8000), HttpRequestHandler)
+        httpd.serve_forever()
+    else:
+        gpu_data.get_data()
@@ -1,6 +1,11 @@
-import urllib.request
-from urllib.error import HTTPError, URLError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
+import http.client
+import curses
+import sqlite3
+import gzip
+import threading
 import json
 import re
 import sys
@@ -12,14 +17,43 @@ from socket import timeout
 import time
 import logging as log
 import argparse
+import statistics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.httpcache import CachedBody, cached_response
 
 
 parser = argparse.ArgumentParser(description='API client')
 
 parser.add_argument('-s', '--server-list', type=str, nargs='+', default=['http://localhost:8000/api/v1', ])
 parser.add_argument('-i', '--interval', type=int, default=2, help='Get data interval')
+parser.add_argument('-t', '--timeout', type=float, default=2, help='Per host timeout')
+parser.add_argument('-w', '--workers', type=int, default=32, help='Max hosts polled at once')
+parser.add_argument('--max-backoff', type=int, default=60, help='Max retry delay for failing hosts')
 parser.add_argument('--show-host', action='store_true', default=False, help='Show host info')
 parser.add_argument('-D', '--daemon', action='store_true', default=False, help='Daemon mode')
+parser.add_argument('--tui', action='store_true', default=False, help='Full screen mode, q - quit, '
+                    't/f/l/p/c/m - sort by temp/fan/load/power/core/mem, n - by name, r - reverse, / - filter, '
+                    'PgUp/PgDn - pages')
+parser.add_argument('--analyze', action='store_true', default=False, help='Print cards which differ most from their rig and model')
+parser.add_argument('--top', type=int, default=10, help='Anomalies to show in analyze mode')
+parser.add_argument('--store', type=str, help='SQLite file to keep polled samples in')
+parser.add_argument('--retention-raw', type=str, default='24h', help='Keep raw samples (s/m/h/d)')
+parser.add_argument('--retention-1m', type=str, default='7d', help='Keep 1 minute rollups')
+parser.add_argument('--retention-1h', type=str, default='365d', help='Keep 1 hour rollups')
+parser.add_argument('--query', type=str, metavar='METRIC', help='Query the store, e.g. --query power_current --agg avg --by rig --since 24h')
+parser.add_argument('--agg', type=str, default='avg', choices=['avg', 'min', 'max'])
+parser.add_argument('--by', type=str, default='rig', choices=['rig', 'card', 'model'])
+parser.add_argument('--since', type=str, default='24h')
+parser.add_argument('--aggregate', action='store_true', default=False, help='Poll the fleet and serve /api/v1/fleet')
+parser.add_argument('--listen-port', type=int, default=8001, help='Aggregator port')
+parser.add_argument('--stale-after', type=int, help='Mark rig data stale after N seconds (default 3 intervals)')
 parser.add_argument('--debug', action='store_true', default=False, help='Debug mode')
 
 args = parser.parse_args()
@@ -39,6 +73,16 @@ API_KEYS = (
     'temp', 'fan', 'power_current', 'power_max',
     'core_load', 'core_clock', 'mem_clock', 'mem_used', 'mem_total', 'vendor',
 )
+CARD_DEFAULTS = dict.fromkeys(API_KEYS, 'null')
+CARD_DEFAULTS['fill'] = ' '
+
+# key, title, width
+TUI_COLUMNS = (
+    ('host', 'host', 22), ('name', 'card', 8), ('vendor', 'vendor', 8), ('temp', 'temp C', 7),
+    ('fan', 'fan %', 6), ('core_load', 'load %', 7), ('power_current', 'power W', 8),
+    ('core_clock', 'core Mhz', 9), ('mem_clock', 'mem Mhz', 8), ('card_model', 'model', 24),
+)
+TUI_SORT_KEYS = dict(t='temp', f='fan', l='core_load', p='power_current', c='core_clock', m='mem_clock')
 
 
 def print_table(data):
@@ -50,13 +94,11 @@ def print_table(data):
     t_body = ('temp', 'fan', 'core_load', 'power_current', 'core_clock', 'mem_clock')
 
     for i in j:
-        api_data = i.get('cards')
+        api_data = i.get('cards', [])
 
-        for card in api_data:
-            for key in card.keys():
-                if key not in API_KEYS:
-                    card[key] = 'null'
-            card.update(dict(fill=' '))
+        for api_card in api_data:
+            card = dict(CARD_DEFAULTS)
+            card.update(api_card)
 
             d['head'].append('+{}'.format('-' * 18))
             d['name'].append('| {name:17}'.format(**card))
@@ -83,30 +125,630 @@ def print_row(d, key, newline=''):
     print('{data}{end}{newline}'.format(data=''.join(d[key]), end=end, newline=newline))
 
 
-def get_stat():
-    res = []
+class Host():
+    """
+    API server with a persistent connection. Hosts which keep failing are
+    retried with exponential backoff.
+    """
+    def __init__(self, url, timeout=args.timeout):
+        self.url = url
+        self.timeout = timeout
+        o = urlparse(url)
+        self.netloc = o.netloc
+        self.hostname = o.hostname
+        self.port = o.port
+        self.https = o.scheme == 'https'
+        self.path = '{}?{}'.format(o.path, o.query) if o.query else o.path or '/'
+
+        self.conn = None
+        self.etag = None
+        self.body = None
+        self.failures = 0
+        self.retry_ts = 0
+
+        # aggregator state, last good data
+        self.data = None
+        self.data_body = None
+        self.last_ok = None
+        self.error = None
+        self.stored_body = None
+
+    def ready(self):
+        return time.monotonic() >= self.retry_ts
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+
+    def request(self):
+        if self.conn is None:
+            conn_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.conn = conn_class(self.hostname, self.port, timeout=self.timeout)
+
+        headers = {'Accept-Encoding': 'gzip'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+
+        self.conn.request('GET', self.path, headers=headers)
+        resp = self.conn.getresponse()
+        body = resp.read()
+        if resp.will_close:
+            self.close()
+
+        if resp.status == 304 and self.body is not None:
+            return self.body
+        if resp.status != 200:
+            raise http.client.HTTPException('HTTP Error {}: {}'.format(resp.status, resp.reason))
+
+        if resp.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        self.etag = resp.getheader('ETag')
+        self.body = body.decode('utf-8')
+        return self.body
+
+    def fetch(self):
+        reused = self.conn is not None
+
+        try:
+            try:
+                return self.request()
+            except ConnectionError:
+                if not reused:
+                    raise
+                # keep-alive connection was closed by the server, retry once on a new one
+                self.close()
+                return self.request()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            self.failures += 1
+            self.retry_ts = time.monotonic() + min(args.interval * 2 ** (self.failures - 1), args.max_backoff)
+            raise
+
+    def ok(self):
+        self.failures = 0
+        self.retry_ts = 0
+
+
+STORE_METRICS = ('temp', 'fan', 'core_load', 'power_current', 'core_clock', 'mem_clock', 'mem_used')
+STORE_ROLLUPS = (('rollup_1m', 60), ('rollup_1h', 3600))
+DURATION_UNITS = dict(s=1, m=60, h=3600, d=86400)
+
+
+def parse_duration(value):
+    if value[-1:] in DURATION_UNITS:
+        return int(value[:-1]) * DURATION_UNITS[value[-1]]
+    return int(value)
+
+
+class Store():
+    """
+    SQLite store for polled samples. Raw samples and 1m/1h min/max/sum/count
+    rollups are written in one transaction per poll cycle, old rows are
+    evicted by retention.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS samples (ts REAL, rig TEXT, card TEXT, model TEXT, {})'.format(
+            ', '.join('{} REAL'.format(x) for x in STORE_METRICS)))
+        self.db.execute('CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts)')
+        for table, step in STORE_ROLLUPS:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS {} (bucket INTEGER, rig TEXT, card TEXT, model TEXT, metric TEXT, '
+                'v_min REAL, v_max REAL, v_sum REAL, n INTEGER, PRIMARY KEY (bucket, rig, card, metric))'.format(table))
+        self.db.commit()
+
+        self.retention = dict(
+            samples=parse_duration(args.retention_raw),
+            rollup_1m=parse_duration(args.retention_1m),
+            rollup_1h=parse_duration(args.retention_1h),
+        )
+        self.evict_interval = 60
+        self.evict_ts = 0
+        self.rows = []
+
+    def add(self, ts, rig, resp):
+        try:
+            j = json.loads(resp)
+        except ValueError:
+            return
+
+        for card in (card for i in j for card in i.get('cards', [])):
+            values = [card.get(k) if isinstance(card.get(k), (int, float)) else None for k in STORE_METRICS]
+            self.rows.append([ts, rig, card.get('name'), card.get('card_model') or card.get('vendor')] + values)
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        now = time.time()
+
+        with self.db:
+            if rows:
+                self.db.executemany('INSERT INTO samples VALUES ({})'.format(','.join('?' * (4 + len(STORE_METRICS)))), rows)
+                for table, step in STORE_ROLLUPS:
+                    self.db.executemany(
+                        'INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1) ON CONFLICT (bucket, rig, card, metric) DO UPDATE SET '
+                        'v_min = min(v_min, excluded.v_min), v_max = max(v_max, excluded.v_max), '
+                        'v_sum = v_sum + excluded.v_sum, n = n + 1'.format(table),
+                        (
+                            (int(row[0]) // step * step, row[1], row[2], row[3], metric, value, value, value)
+                            for row in rows
+                            for metric, value in zip(STORE_METRICS, row[4:])
+                            if value is not None
+                        ),
+                    )
+
+            if now - self.evict_ts > self.evict_interval:
+                self.evict_ts = now
+                self.db.execute('DELETE FROM samples WHERE ts < ?', (now - self.retention['samples'], ))
+                for table, step in STORE_ROLLUPS:
+                    self.db.execute('DELETE FROM {} WHERE bucket < ?'.format(table), (now - self.retention[table], ))
+
+    def query(self, metric, agg, by, since):
+        """
+        Aggregate one metric per rig, card or model over the last `since`
+        seconds, from the finest rollup which still covers the window
+        """
+        table = next((t for t, step in STORE_ROLLUPS if since <= self.retention[t]), STORE_ROLLUPS[-1][0])
+        expr = dict(avg='sum(v_sum) / sum(n)', min='min(v_min)', max='max(v_max)')[agg]
+        group = 'rig || \' \' || card' if by == 'card' else by
+        sql = 'SELECT {group}, {expr}, sum(n) FROM {table} WHERE metric = ? AND bucket >= ? GROUP BY 1 ORDER BY 1'.format(
+            group=group, expr=expr, table=table)
+        return self.db.execute(sql, (metric, time.time() - since)).fetchall()
+
 
-    for i in args.server_list:
-        o = urlparse(i)
-        host, port = o.scheme, o.port
-        url = o.geturl()
+def print_query():
+    if args.query not in STORE_METRICS:
+        log.error('Unknown metric \"{}\", choose from: {}'.format(args.query, ', '.join(STORE_METRICS)))
+        sys.exit(1)
+
+    rows = STORE.query(args.query, args.agg, args.by, parse_duration(args.since))
+    print('{:32} {:>12} {:>10}'.format(args.by, '{}({})'.format(args.agg, args.query), 'samples'))
+    for key, value, count in rows:
+        print('{:32} {:12.2f} {:10}'.format(str(key), value, count))
+
+
+STORE = Store(args.store) if args.store else None
+HOSTS = [Host(x) for x in args.server_list]
+POOL = ThreadPoolExecutor(max_workers=max(1, min(args.workers, len(HOSTS))))
+
+
+def poll_hosts():
+    """
+    Poll every host which is not backing off. Yields (host, response) as
+    responses arrive, response is None if the host failed.
+    """
+    futures = {}
+
+    for host in HOSTS:
+        if host.ready():
+            futures[POOL.submit(host.fetch)] = host
+        else:
+            log.debug('Skipping {}, retry in {:.0f} seconds'.format(host.url, host.retry_ts - time.monotonic()))
 
+    for future in as_completed(futures):
+        host = futures[future]
         try:
-            resp = urllib.request.urlopen(url, timeout=2).read().decode('utf-8')
-        except (HTTPError, URLError) as error:
-            log.error('Data is not retrieved. Error: {}\nURL: {}\n'.format(error, url))
+            resp = future.result()
         except timeout:
-            log.error('Time out. URL: {}\n'.format(url))
+            host.error = 'Time out'
+            log.error('Time out. URL: {}\n'.format(host.url))
+        except (OSError, http.client.HTTPException) as error:
+            host.error = str(error)
+            log.error('Data is not retrieved. Error: {}\nURL: {}\n'.format(error, host.url))
+        else:
+            host.ok()
+            if STORE is not None and resp is not host.stored_body:
+                host.stored_body = resp
+                STORE.add(time.time(), host.netloc, resp)
+            yield host, resp
+            continue
+        yield host, None
+
+    if STORE is not None:
+        STORE.flush()
+
+
+def get_stat():
+    for host, resp in poll_hosts():
+        if resp is None:
+            continue
+        if args.show_host:
+            log.info('Host: {}'.format(host.netloc))
+            log.info('API url: {}'.format(host.url))
+        print_table(resp)
+
+
+class Tui():
+    """
+    Full screen table, one row per card. Only cells which changed since the
+    previous frame are redrawn. Sorting, filtering and paging work on the
+    last polled data.
+    """
+    def __init__(self, screen):
+        self.screen = screen
+        self.cards = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.dirty = True
+
+        self.sort_key = None
+        self.reverse = False
+        self.filter = ''
+        self.page = 0
+        self.frame = {}
+
+    def update(self, host, resp):
+        with self.lock:
+            if resp is None:
+                self.failed.add(host.netloc)
+            else:
+                self.failed.discard(host.netloc)
+                try:
+                    j = json.loads(resp)
+                except ValueError:
+                    self.failed.add(host.netloc)
+                else:
+                    self.cards[host.netloc] = [card for i in j for card in i.get('cards', [])]
+            self.dirty = True
+
+    def poll_loop(self):
+        while True:
+            start = time.monotonic()
+            for host, resp in poll_hosts():
+                self.update(host, resp)
+            time.sleep(max(0, args.interval - (time.monotonic() - start)))
+
+    def get_rows(self):
+        rows = []
+
+        with self.lock:
+            for netloc, cards in self.cards.items():
+                host = netloc + (' (!)' if netloc in self.failed else '')
+                for card in cards:
+                    row = dict(CARD_DEFAULTS)
+                    row.update(card)
+                    row['host'] = host
+                    rows.append(row)
+
+        if self.filter:
+            rows = [x for x in rows if any(self.filter in str(x.get(k)) for k, _, _ in TUI_COLUMNS)]
+
+        if self.sort_key:
+            def sort_value(row):
+                value = row.get(self.sort_key)
+                return value if isinstance(value, (int, float)) else -1
+            rows.sort(key=sort_value, reverse=self.reverse)
         else:
-            if args.show_host:
-                log.info('Host: {}'.format(o.netloc))
-                log.info('API url: {}'.format(url))
-            print_table(resp)
+            rows.sort(key=lambda x: (x['host'], str(x['name'])), reverse=self.reverse)
+        return rows
 
+    def put(self, y, x, text, attr=0):
+        if self.frame.get((y, x)) == (text, attr):
+            return
+        self.frame[(y, x)] = (text, attr)
+        try:
+            self.screen.addstr(y, x, text, attr)
+        except curses.error:
+            pass  # bottom right corner
+
+    def draw(self):
+        height, width = self.screen.getmaxyx()
+        rows = self.get_rows()
+        per_page = max(1, height - 2)
+        pages = max(1, (len(rows) + per_page - 1) // per_page)
+        self.page = min(self.page, pages - 1)
+        drawn = set()
+
+        columns = []
+        x = 0
+        for key, title, size in TUI_COLUMNS:
+            if x + size > width:
+                break
+            columns.append((key, title, size, x))
+            x += size
+
+        status = ' {} cards, {}/{} hosts ok | sort: {}{} | filter: {} | page {}/{} '.format(
+            len(rows), len(HOSTS) - len(self.failed), len(HOSTS),
+            self.sort_key or 'name', ' desc' if self.reverse else '', self.filter or '-', self.page + 1, pages,
+        )
+        cells = [(0, 0, status[:width - 1].ljust(width - 1), curses.A_REVERSE)]
+        cells.extend((1, x, title[:size - 1].ljust(size), curses.A_BOLD) for key, title, size, x in columns)
+
+        for y, row in enumerate(rows[self.page * per_page:(self.page + 1) * per_page], 2):
+            for key, title, size, x in columns:
+                cells.append((y, x, str(row.get(key))[:size - 1].ljust(size), 0))
+
+        for y, x, text, attr in cells:
+            self.put(y, x, text, attr)
+            drawn.add((y, x))
+
+        for y, x in [k for k in self.frame if k not in drawn]:
+            text, attr = self.frame.pop((y, x))
+            try:
+                self.screen.addstr(y, x, ' ' * len(text))
+            except curses.error:
+                pass
+        self.screen.refresh()
+
+    def read_filter(self):
+        height, width = self.screen.getmaxyx()
+        curses.echo()
+        curses.curs_set(1)
+        self.screen.addstr(height - 1, 0, 'filter: '.ljust(width - 1))
+        self.screen.timeout(-1)
+        self.filter = self.screen.getstr(height - 1, 8, 64).decode('utf-8').strip()
+        self.screen.timeout(200)
+        curses.noecho()
+        curses.curs_set(0)
+        self.screen.clear()
+        self.frame = {}
+
+    def handle_key(self, key):
+        if key in (ord('q'), 27):
+            return False
+        elif key == curses.KEY_RESIZE:
+            self.screen.clear()
+            self.frame = {}
+        elif key == ord('/'):
+            self.read_filter()
+        elif key == ord('n'):
+            self.sort_key = None
+            self.reverse = False
+        elif key == ord('r'):
+            self.reverse = not self.reverse
+        elif key in (curses.KEY_NPAGE, ord(' ')):
+            self.page += 1
+        elif key in (curses.KEY_PPAGE, ord('b')):
+            self.page = max(0, self.page - 1)
+        elif 0 <= key < 256 and chr(key) in TUI_SORT_KEYS:
+            self.sort_key = TUI_SORT_KEYS[chr(key)]
+            self.reverse = True
+        return True
+
+    def run(self):
+        curses.curs_set(0)
+        self.screen.timeout(200)
+        threading.Thread(target=self.poll_loop, daemon=True).start()
+
+        while True:
+            key = self.screen.getch()
+            if key != -1:
+                if not self.handle_key(key):
+                    return
+                self.dirty = True
+            if self.dirty:
+                self.dirty = False
+                self.draw()
+
+
+def run_tui(screen):
+    Tui(screen).run()
+
+
+# minimal spread used for scores, so identical cards do not turn noise into outliers
+ANOMALY_FLOOR = dict(core_load=5, power_current=5, temp=3)
+ANOMALY_MIN_SCORE = 3
+MAD_SCALE = 1.4826
+
+
+def robust_z(values, groups, floor):
+    """
+    Signed distance of every value from its group median in MAD units.
+    Missing values (None) score 0.
+    """
+    if np is not None:
+        v = np.array([np.nan if x is None else x for x in values], dtype=float)
+        g = np.asarray(groups)
+        z = np.zeros(len(v))
+        for key in np.unique(g):
+            idx = (g == key) & ~np.isnan(v)
+            if not idx.any():
+                continue
+            median = np.median(v[idx])
+            mad = np.median(np.abs(v[idx] - median)) * MAD_SCALE
+            z[idx] = (v[idx] - median) / max(mad, floor)
+        return z.tolist()
+
+    by_group = defaultdict(list)
+    for x, key in zip(values, groups):
+        if x is not None:
+            by_group[key].append(x)
+
+    spread = {}
+    for key, group in by_group.items():
+        median = statistics.median(group)
+        mad = statistics.median([abs(x - median) for x in group]) * MAD_SCALE
+        spread[key] = (median, max(mad, floor))
+
+    return [0 if x is None else (x - spread[key][0]) / spread[key][1] for x, key in zip(values, groups)]
+
+
+def fit_residuals(x, y, groups):
+    """
+    Residuals of a per group least squares line y = a * x + b
+    """
+    by_group = defaultdict(list)
+    for idx, key in enumerate(groups):
+        if x[idx] is not None and y[idx] is not None:
+            by_group[key].append(idx)
+
+    res = [None] * len(y)
+    for key, idx in by_group.items():
+        if len(idx) < 3:
+            continue
+        if np is not None:
+            gx = np.array([x[i] for i in idx], dtype=float)
+            gy = np.array([y[i] for i in idx], dtype=float)
+            a, b = np.polyfit(gx, gy, 1) if gx.std() else (0, gy.mean())
+            for i, r in zip(idx, (gy - (a * gx + b)).tolist()):
+                res[i] = r
+        else:
+            mx = statistics.mean(x[i] for i in idx)
+            my = statistics.mean(y[i] for i in idx)
+            sxx = sum((x[i] - mx) ** 2 for i in idx)
+            a = sum((x[i] - mx) * (y[i] - my) for i in idx) / sxx if sxx else 0
+            b = my - a * mx
+            for i in idx:
+                res[i] = y[i] - (a * x[i] + b)
+    return res
+
+
+def find_anomalies(cards):
+    """
+    cards - list of (rig, card dict). Load is compared to the rig median,
+    power to the card model median, temperature to what the fan speed of
+    the same model predicts.
+    """
+    def column(key):
+        return [x[1].get(key) if isinstance(x[1].get(key), (int, float)) else None for x in cards]
+
+    rigs = [x[0] for x in cards]
+    models = [str(x[1].get('card_model') or x[1].get('vendor')) for x in cards]
+    load, power, temp, fan = column('core_load'), column('power_current'), column('temp'), column('fan')
+
+    load_z = robust_z(load, rigs, ANOMALY_FLOOR['core_load'])
+    power_z = robust_z(power, models, ANOMALY_FLOOR['power_current'])
+    temp_z = robust_z(fit_residuals(fan, temp, models), models, ANOMALY_FLOOR['temp'])
 
-if args.daemon:
+    res = []
+    for idx, (rig, card) in enumerate(cards):
+        checks = (
+            (-load_z[idx], 'low load', 'load {} %'.format(load[idx])),
+            (abs(power_z[idx]), 'power drift', 'power {} W'.format(power[idx])),
+            (abs(temp_z[idx]), 'temp/fan', 'temp {} C at fan {} %'.format(temp[idx], fan[idx])),
+        )
+        score, kind, detail = max(checks)
+        if score >= ANOMALY_MIN_SCORE:
+            res.append((round(score, 1), kind, rig, card.get('name'), models[idx], detail))
+    res.sort(reverse=True)
+    return res
+
+
+def print_anomalies(anomalies, top):
+    print('{:>6}  {:12} {:22} {:7} {:24} {}'.format('score', 'kind', 'rig', 'card', 'model', 'detail'))
+    for i in anomalies[:top]:
+        print('{:6}  {:12} {:22} {:7} {:24} {}'.format(*i))
+    print('{} anomalies\n'.format(len(anomalies)))
+
+
+def analyze():
+    cards = []
+
+    for host, resp in poll_hosts():
+        if resp is None:
+            continue
+        try:
+            j = json.loads(resp)
+        except ValueError:
+            log.error('Invalid JSON. URL: {}'.format(host.url))
+            continue
+        cards.extend((host.netloc, card) for i in j for card in i.get('cards', []))
+
+    print_anomalies(find_anomalies(cards), args.top)
+
+
+FLEET = None
+
+
+class Fleet(CachedBody):
+    """
+    Merged fleet data, serialized once per poll cycle
+    """
+    def __init__(self, hosts, stale_after):
+        now = time.time()
+        rigs = []
+
+        for host in hosts:
+            age = round(now - host.last_ok, 1) if host.last_ok else None
+            rigs.append(dict(
+                url=host.url,
+                host=host.netloc,
+                ok=host.error is None,
+                error=host.error,
+                last_ok=host.last_ok,
+                age=age,
+                stale=age is None or age > stale_after,
+                data=host.data,
+            ))
+
+        super().__init__(json.dumps(dict(ts=now, rigs=rigs)).encode('utf-8'))
+
+
+def aggregate():
+    global FLEET
+
+    for host, resp in poll_hosts():
+        if resp is None:
+            continue
+        if resp is not host.data_body:
+            try:
+                host.data = json.loads(resp)
+            except ValueError as e:
+                host.error = 'Invalid JSON: {}'.format(e)
+                log.error('{} URL: {}'.format(host.error, host.url))
+                continue
+            host.data_body = resp
+        host.last_ok = time.time()
+        host.error = None
+
+    FLEET = Fleet(HOSTS, args.stale_after or args.interval * 3)
+
+
+def aggregate_loop():
+    while True:
+        start = time.monotonic()
+        aggregate()
+        time.sleep(max(0, args.interval - (time.monotonic() - start)))
+
+
+class FleetRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        fleet = FLEET
+
+        if urlparse(self.path).path != '/api/v1/fleet':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        code, headers, body = cached_response(fleet, self.headers, [('Access-Control-Allow-Origin', '*')])
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        if code != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if args.query:
+    if STORE is None:
+        log.error('--query needs --store')
+        sys.exit(1)
+    print_query()
+elif args.aggregate:
+    aggregate()
+    threading.Thread(target=aggregate_loop, daemon=True).start()
+    log.info('Aggregator listening on port {}...'.format(args.listen_port))
+    httpd = ThreadingHTTPServer(('0.0.0.0', args.listen_port), FleetRequestHandler)
+    httpd.daemon_threads = True
+    httpd.serve_forever()
+elif args.analyze:
+    while True:
+        start = time.monotonic()
+        analyze()
+        if not args.daemon:
+            break
+        time.sleep(max(0, args.interval - (time.monotonic() - start)))
+elif args.tui:
+    log.getLogger().setLevel(log.CRITICAL)
+    curses.wrapper(run_tui)
+elif args.daemon:
     while True:
+        start = time.monotonic()
         get_stat()
-        time.sleep(args.interval)
+        time.sleep(max(0, args.interval - (time.monotonic() - start)))
 else:
     get_stat()
@@ -0,0 +1,68 @@
+import gzip
+import hashlib
+
+
+# Shared by the API servers (api/api.py and the fleet aggregator in
+# api/client.py): a JSON body is serialized and compressed once, every
+# request only picks the representation and checks If-None-Match. The
+# identity and gzip bodies are different representations, so each one has
+# its own strong ETag.
+
+GZIP_CODINGS = ('gzip', 'x-gzip', '*')
+
+
+class CachedBody():
+    """
+    Response body with its gzip copy and ETags, built once per refresh
+    """
+    def __init__(self, body):
+        self.body = body
+        self.body_gzip = gzip.compress(body)
+        digest = hashlib.sha1(body).hexdigest()
+        self.etag = '"{}"'.format(digest)
+        self.etag_gzip = '"{}-gz"'.format(digest)
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Accept-Encoding with q-values, "gzip;q=0" and "*;q=0" refuse gzip
+    """
+    codings = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+
+    for coding in GZIP_CODINGS:
+        if coding in codings:
+            return codings[coding] > 0
+    return False
+
+
+def cached_response(cached, request_headers, headers=()):
+    """
+    (http code, headers, body) for a CachedBody, 304 if If-None-Match has
+    the ETag of the representation the client accepts
+    """
+    use_gzip = accepts_gzip(request_headers.get('Accept-Encoding', ''))
+    etag = cached.etag_gzip if use_gzip else cached.etag
+
+    if_none_match = [x.strip() for x in request_headers.get('If-None-Match', '').split(',')]
+    if etag in if_none_match or '*' in if_none_match:
+        return 304, [('ETag', etag), ('Vary', 'Accept-Encoding')], b''
+
+    headers = [('Content-type', 'application/json'), ('ETag', etag), ('Vary', 'Accept-Encoding')] + list(headers)
+    if use_gzip:
+        headers.append(('Content-Encoding', 'gzip'))
+        return 200, headers, cached.body_gzip
+    return 200, headers, cached.body
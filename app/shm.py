@@ -0,0 +1,171 @@
+import os
+import mmap
+import time
+import struct
+import logging as log
+
+
+# One writer (api/api.py collector) publishes every GPU snapshot to a file in
+# /dev/shm, local readers (miner.py, nvset.py) map the same file and read it
+# without a request to the API. The generation counter works as a seqlock:
+# it is odd while the writer updates the file, a reader retries if it saw an
+# odd value or the value changed during the read.
+
+SHM_PATH = '/dev/shm/rig-telemetry'
+SHM_MAGIC = b'RIGT'
+SHM_VERSION = 1
+SHM_MAX_CARDS = 32
+SHM_MISSING = -2 ** 31
+
+SHM_METRICS = (
+    'temp', 'fan', 'core_load', 'mem_load', 'power_current', 'power_max',
+    'core_clock', 'mem_clock', 'mem_used', 'mem_total',
+)
+
+# magic, version, max cards, generation, ts (time.time), monotonic ts, cards, slot size
+SHM_HEADER = struct.Struct('<4sHHQddII')
+SHM_HEADER_SIZE = 64
+SHM_GENERATION = struct.Struct('<Q')
+SHM_GENERATION_OFFSET = 8
+# index, bus_id, metrics
+SHM_SLOT = struct.Struct('<i32s{}i'.format(len(SHM_METRICS)))
+SHM_SIZE = SHM_HEADER_SIZE + SHM_SLOT.size * SHM_MAX_CARDS
+
+
+def to_int(value):
+    if value is None:
+        return SHM_MISSING
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return SHM_MISSING
+
+
+class TelemetryWriter():
+    """
+    Single writer of the telemetry file, the layout is fixed so readers
+    never have to remap it.
+    """
+    def __init__(self, path=SHM_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SHM_SIZE)
+            self.mm = mmap.mmap(fd, SHM_SIZE)
+        finally:
+            os.close(fd)
+
+        magic, version = SHM_HEADER.unpack_from(self.mm, 0)[:2]
+        if (magic, version) == (SHM_MAGIC, SHM_VERSION):
+            # keep counting, readers may hold the previous generation
+            self.generation = SHM_GENERATION.unpack_from(self.mm, SHM_GENERATION_OFFSET)[0] & ~1
+        else:
+            self.generation = 0
+
+    def publish(self, cards, ts=None, mono_ts=None):
+        """
+        ts and mono_ts are the sample time (time.time() and time.monotonic())
+        """
+        cards = cards[:SHM_MAX_CARDS]
+
+        SHM_GENERATION.pack_into(self.mm, SHM_GENERATION_OFFSET, self.generation + 1)
+        for idx, card in enumerate(cards):
+            SHM_SLOT.pack_into(
+                self.mm, SHM_HEADER_SIZE + idx * SHM_SLOT.size,
+                to_int(card.get('index')), str(card.get('bus_id', '')).encode('utf-8')[:32],
+                *[to_int(card.get(k)) for k in SHM_METRICS]
+            )
+        self.generation += 2
+        SHM_HEADER.pack_into(
+            self.mm, 0,
+            SHM_MAGIC, SHM_VERSION, SHM_MAX_CARDS, self.generation - 1,
+            ts or time.time(), mono_ts or time.monotonic(), len(cards), SHM_SLOT.size,
+        )
+        SHM_GENERATION.pack_into(self.mm, SHM_GENERATION_OFFSET, self.generation)
+
+    def close(self):
+        self.mm.close()
+
+
+class TelemetryReader():
+    """
+    Reads the telemetry file straight from the mapping. read() returns None
+    if there is no file, it is from an unknown version or older than max_age
+    seconds, then the caller falls back to its own data source.
+    """
+    def __init__(self, path=SHM_PATH, max_age=10, retries=100):
+        self.path = path
+        self.max_age = max_age
+        self.retries = retries
+        self.mm = None
+        self.inode = None
+
+    def open(self):
+        try:
+            with open(self.path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                if st.st_size < SHM_SIZE:
+                    return False
+                self.mm = mmap.mmap(f.fileno(), SHM_SIZE, access=mmap.ACCESS_READ)
+                self.inode = st.st_ino
+        except OSError:
+            return False
+        return True
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = None
+
+    def reopen_if_replaced(self):
+        try:
+            replaced = os.stat(self.path).st_ino != self.inode
+        except OSError:
+            replaced = True
+        if replaced:
+            self.close()
+        return replaced
+
+    def read_consistent(self):
+        for attempt in range(self.retries):
+            gen = SHM_GENERATION.unpack_from(self.mm, SHM_GENERATION_OFFSET)[0]
+            if gen & 1:
+                time.sleep(0)
+                continue
+
+            header = SHM_HEADER.unpack_from(self.mm, 0)
+            cards = min(header[6], SHM_MAX_CARDS)
+            slots = [SHM_SLOT.unpack_from(self.mm, SHM_HEADER_SIZE + idx * SHM_SLOT.size) for idx in range(cards)]
+
+            if SHM_GENERATION.unpack_from(self.mm, SHM_GENERATION_OFFSET)[0] == gen:
+                return gen, header, slots
+        log.debug('Telemetry is being written too often, giving up')
+        return None
+
+    def read(self):
+        """
+        [dict(index=0, bus_id='...', temp=60, ...), ...], generation, monotonic ts
+        """
+        if self.mm is None and not self.open():
+            return None
+
+        data = self.read_consistent()
+        if data is None:
+            return None
+        gen, header, slots = data
+        magic, version, max_cards, _, ts, mono_ts, cards, slot_size = header
+
+        if (magic, version, slot_size) != (SHM_MAGIC, SHM_VERSION, SHM_SLOT.size) or gen == 0:
+            self.reopen_if_replaced()
+            return None
+        if time.monotonic() - mono_ts > self.max_age:
+            # the writer or its backend is stuck, or the writer was restarted with a new file
+            self.reopen_if_replaced()
+            return None
+
+        result = []
+        for slot in slots:
+            card = dict(index=slot[0], bus_id=slot[1].rstrip(b'\0').decode('utf-8', 'replace'))
+            card.update((k, None if v == SHM_MISSING else v) for k, v in zip(SHM_METRICS, slot[2:]))
+            result.append(card)
+        return result, gen, mono_ts
@@ -2,18 +2,27 @@ from app.core import check_python
 
 check_python()
 
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, deque
 import os
+import re
 import sys
+import stat
+import select
+import threading
 import json
 import time
+import socket
+import http.client
 import logging as log
 import argparse
 import datetime
+import heapq
 import configparser
+from concurrent.futures import ThreadPoolExecutor
 
 from app.core import run_proc, read_api, check_port, write_file
 from app.settings import API_URL
+from app.shm import SHM_PATH, TelemetryReader
 
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -22,19 +31,42 @@ MINER = dict(
     generic=dict(class_name='GenericMiner', minimal_gpu_load=50),
     ethminer=dict(class_name='EthMiner', port=3333, url='/'),
     ewbf=dict(class_name='EwbfMiner', port=42000, url='getstat'),
+    ccminer=dict(class_name='CcMiner', port=4068, url=''),
 )
 MINER_CHOICES = list(MINER.keys())
+
+XID_REGEX = re.compile(r'NVRM\:\sXid\s\(PCI\:(?P<bus_id>\w+\:\w{2}\:\w{2})\)\:\s(?P<xid>\d+)')
 MINER_DEFAULT = 'generic'
 
 
 parser = argparse.ArgumentParser(description='Miner run tool')
 parser.add_argument('--minimal-gpu-load', type=int, required=False, default=75, help='Minimal GPU load')
 parser.add_argument('--minimal-hashrate', type=int, required=False, help='Miner minimal hashrate')
+parser.add_argument('--minimal-gpu-hashrate', type=float, required=False,
+                    help='Per-GPU minimal hashrate (ccminer), default is minimal hashrate / number of GPUs')
 parser.add_argument('--hashrate-delta-reboot', type=int, default=15)
 parser.add_argument('--miner-name', type=str, choices=MINER_CHOICES, default=MINER_DEFAULT, help='Miner name')
 parser.add_argument('--miner-api-host', type=str, default='localhost', help='Miner API host')
 parser.add_argument('--miner-api-port', type=int, required=False, help='Miner API port')
+parser.add_argument('--miner-api-timeout', type=float, default=0.5, help='Miner API timeout in seconds')
 parser.add_argument('--sys-reboot-delay', type=int, default=60)
+parser.add_argument('--miner-restart-cmd', type=str, help='Shell command which restarts the miner process')
+parser.add_argument('--gpu-reset-cmd', type=str, help='Shell command which resets the GPUs, e.g. "sudo nvidia-smi -r"')
+parser.add_argument('--rpc-restart-cooldown', type=int, default=120, help='Seconds to wait for a miner RPC restart to help')
+parser.add_argument('--proc-restart-cooldown', type=int, default=180, help='Seconds to wait for a miner process restart to help')
+parser.add_argument('--gpu-reset-cooldown', type=int, default=300, help='Seconds to wait for a GPU reset to help')
+parser.add_argument('--recovery-reset-after', type=int, default=3600,
+                    help='Start the recovery ladder over after this many seconds without failures')
+parser.add_argument('--load-window', type=int, default=16, help='GPU load samples kept per GPU (generic miner)')
+parser.add_argument('--load-below', type=int, default=16, help='Reboot if this many samples in the window are below the minimal load')
+parser.add_argument('--shm-path', type=str, default=SHM_PATH, help='Telemetry file published by api.py, empty to disable')
+parser.add_argument('--shm-max-age', type=float, default=10, help='Telemetry older than this (seconds) is ignored')
+parser.add_argument('--interval', type=float, default=1, help='Watchdog interval in seconds')
+parser.add_argument('--watch', type=str, nargs='+', action='append', metavar='NAME [KEY=VALUE ...]',
+                    help='Watch several miners, e.g. --watch ethminer port=3333 minimal_hashrate=280 '
+                         '--watch generic gpus=0-5 minimal_gpu_load=60 interval=2')
+parser.add_argument('--kmsg-path', type=str, default='/dev/kmsg', help='Kernel log device (or a file in the same format)')
+parser.add_argument('--fatal-xid', type=int, nargs='*', default=[79], help='NVRM Xid codes which need a reboot')
 parser.add_argument('--debug', action='store_true', default=False, help='Debug mode')
 
 
@@ -49,20 +81,26 @@ log.basicConfig(format='[%(levelname)s] %(message)s', level=LOG_LEVEL)
 
 
 def parse_dmesg():
-    import re
+    if KMSG.running:
+        return KMSG.get_lines()
 
-    regex = r'.*NVRM\:\sXid\s\(PCI\:(?P<bus_id>\w+\:\w{2}\:\w{2})\)\:'
     dmesg_out = run_proc('dmesg')
     d = defaultdict(list)
 
     for line in dmesg_out.decode('utf-8').split('\n'):
-        m = re.match(regex, line)
+        m = XID_REGEX.search(line)
         if m:
             key = m.group('bus_id')
             d[key].append(line)
     return d
 
 
+def write_event(msg):
+    ts = datetime.datetime.now().strftime('%d-%b-%Y %H:%M:%S')
+    log_fp = os.path.join(ROOT_DIR, 'error.log')
+    write_file(log_fp, ['[{}] {}'.format(ts, msg)], mode='a')
+
+
 def write_log(d):
     ts = datetime.datetime.now().strftime('%d-%b-%Y %H:%M:%S')
     log_fp = os.path.join(ROOT_DIR, 'error.log')
@@ -84,41 +122,482 @@ def write_log(d):
         log.warning('Nothing to log')
 
 
-def get_json_data(*args, **kw):
-    from socket import timeout
-    import urllib.request
-    from urllib.error import HTTPError, URLError
-    from urllib.parse import urlparse, urljoin
+def sys_reboot(delay=args.sys_reboot_delay, fake=False):
+    cmd = 'sudo reboot -dnf'
+    write_log(parse_dmesg())
+
+    log.warning('System reboot in {} seconds ...'.format(delay))
+    time.sleep(delay)
+    if not fake:
+        os.system(cmd)
+    else:
+        log.debug(cmd)
+
+
+def check_gpu_faults():
+    """
+    Rig wide Xid check, runs as its own watchdog job next to the miners
+    """
+    events = KMSG.pop_new()
+
+    for event in events:
+        log.error('GPU error on bus_id \"{bus_id}\", Xid {xid}: {line}'.format(**event))
+
+    fatal = [x for x in events if x['xid'] in args.fatal_xid]
+    if fatal:
+        reason = 'Fatal Xid {} on {}'.format(fatal[0]['xid'], fatal[0]['bus_id'])
+        log.error(reason)
+        write_event('Recovery: reboot after: {}'.format(reason))
+        sys_reboot(30)
+
+
+class KmsgReader(threading.Thread):
+    """
+    Follows /dev/kmsg and indexes NVRM Xid events by bus_id and Xid code.
+    Records up to the saved sequence number were seen before a restart.
+    Without a cursor the records already in the buffer count as history.
+    A regular file with kmsg records works too, it is followed like tail -f.
+    """
+    def __init__(self, path=args.kmsg_path, cursor_fp=os.path.join(ROOT_DIR, 'kmsg.cursor'), max_events=64):
+        super().__init__(daemon=True)
+        self.path = path
+        self.cursor_fp = cursor_fp
+        self.max_events = max_events
+        self.poll_interval = 1
+        self.cursor_save_interval = 10
+
+        self.running = False
+        self.caught_up = False
+        self.lock = threading.Lock()
+        self.events = defaultdict(dict)
+        self.new_events = deque(maxlen=1024)
+
+        self.boot_id = self.read_boot_id()
+        self.cursor, self.has_cursor = self.load_cursor()
+        self.saved_cursor = self.cursor
+
+    def read_boot_id(self):
+        try:
+            with open('/proc/sys/kernel/random/boot_id') as f:
+                return f.read().strip()
+        except OSError:
+            return ''
+
+    def load_cursor(self):
+        """
+        Sequence numbers restart on boot, the cursor is valid for one boot id
+        """
+        try:
+            with open(self.cursor_fp) as f:
+                boot_id, seq = f.read().split()
+            if boot_id == self.boot_id:
+                return int(seq), True
+        except (OSError, ValueError):
+            pass
+        return -1, False
+
+    def save_cursor(self):
+        if self.cursor != self.saved_cursor:
+            write_file(self.cursor_fp, '{} {}\n'.format(self.boot_id, self.cursor))
+            self.saved_cursor = self.cursor
+
+    def parse(self, line):
+        if not line or line[:1] == b' ':
+            return  # continuation lines with device properties
+
+        header, _, msg = line.decode('utf-8', 'replace').partition(';')
+        try:
+            seq = int(header.split(',')[1])
+        except (IndexError, ValueError):
+            return
+        if seq <= self.cursor:
+            return
+        self.cursor = seq
+
+        m = XID_REGEX.search(msg)
+        if not m:
+            return
+
+        event = dict(seq=seq, bus_id=m.group('bus_id'), xid=int(m.group('xid')), line=msg)
+        with self.lock:
+            by_xid = self.events[event['bus_id']]
+            by_xid.setdefault(event['xid'], deque(maxlen=self.max_events)).append(event)
+            if self.caught_up or self.has_cursor:
+                self.new_events.append(event)
+
+    def run(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            log.error('Error reading \"{}\": {}, using dmesg'.format(self.path, e))
+            return
+
+        is_kmsg = stat.S_ISCHR(os.fstat(fd).st_mode)
+        self.running = True
+        save_ts = time.monotonic()
+        buf = b''
+
+        while True:
+            try:
+                chunk = os.read(fd, 8192)
+            except BrokenPipeError:
+                continue  # records were overwritten before we read them
+            except BlockingIOError:
+                chunk = b''
+
+            if not chunk:
+                self.caught_up = True
+                if time.monotonic() - save_ts > self.cursor_save_interval:
+                    save_ts = time.monotonic()
+                    self.save_cursor()
+                if is_kmsg:
+                    select.select([fd], [], [], self.cursor_save_interval)
+                else:
+                    time.sleep(self.poll_interval)
+                continue
+
+            *lines, buf = (buf + chunk).split(b'\n')
+            for line in lines:
+                self.parse(line)
+
+    def pop_new(self):
+        with self.lock:
+            events = list(self.new_events)
+            self.new_events.clear()
+        return events
+
+    def get_lines(self):
+        """
+        All indexed events as bus_id -> log lines, the format of parse_dmesg
+        """
+        d = defaultdict(list)
+        with self.lock:
+            for bus_id, by_xid in self.events.items():
+                events = sorted((x for q in by_xid.values() for x in q), key=lambda x: x['seq'])
+                d[bus_id] = [x['line'] for x in events]
+        return d
+
+
+class SocketClient():
+    """
+    TCP connection to a miner API which is kept open between requests.
+    After a failure reconnects are delayed with exponential backoff.
+    """
+    def __init__(self, host, port, timeout=args.miner_api_timeout, max_backoff=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+
+        self.sock = None
+        self.buf = b''
+        self.failures = 0
+        self.retry_ts = 0
+
+    def connect(self):
+        if self.sock is not None:
+            return True
+        if time.monotonic() < self.retry_ts:
+            return False
+
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            self.failed(e)
+            return False
+        self.buf = b''
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+
+    def failed(self, error):
+        self.close()
+        self.failures += 1
+        delay = min(2 ** (self.failures - 1), self.max_backoff)
+        self.retry_ts = time.monotonic() + delay
+        log.error('Miner API {}:{} error: {}, next try in {} seconds'.format(self.host, self.port, error, delay))
+
+    def ok(self):
+        self.failures = 0
+
+    def recv(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('timed out')
+        self.sock.settimeout(remaining)
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionResetError('Connection closed by miner')
+        return chunk
+
+    def read_line(self, deadline):
+        while b'\n' not in self.buf:
+            self.buf += self.recv(deadline)
+        line, self.buf = self.buf.split(b'\n', 1)
+        return line
+
+
+class JsonRpcClient(SocketClient):
+    """
+    Line delimited JSON-RPC (ethminer API), responses are matched by id
+    """
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.req_id = 0
+
+    def call(self, method):
+        self.req_id += 1
+        req = json.dumps(dict(id=self.req_id, jsonrpc='2.0', method=method)).encode('utf-8') + b'\n'
+
+        for attempt in range(2):
+            reused = self.sock is not None
+            if not self.connect():
+                return None
+
+            try:
+                self.sock.sendall(req)
+                deadline = time.monotonic() + self.timeout
+                while True:
+                    resp = json.loads(self.read_line(deadline).decode('utf-8'))
+                    if resp.get('id') == self.req_id:
+                        self.ok()
+                        return resp
+                    log.debug('Skipping response with id {}'.format(resp.get('id')))
+            except ConnectionError as e:
+                if reused and attempt == 0:
+                    # miner closed the idle connection, retry on a new one
+                    self.close()
+                    continue
+                self.failed(e)
+            except (OSError, ValueError) as e:
+                self.failed(e)
+            return None
+
+
+class HttpJsonClient():
+    """
+    Keep-alive HTTP connection to a miner JSON API
+    """
+    def __init__(self, host, port, url='', timeout=args.miner_api_timeout):
+        self.host = host
+        self.port = port
+        self.path = '/' + url.lstrip('/')
+        self.timeout = timeout
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+
+    def get(self):
+        for attempt in range(2):
+            reused = self.conn is not None
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+            try:
+                self.conn.request('GET', self.path)
+                resp = self.conn.getresponse()
+                body = resp.read()
+                if resp.will_close:
+                    self.close()
+                if resp.status != 200:
+                    log.error('Miner API returned HTTP {}. URL: {}'.format(resp.status, self.path))
+                    return None
+                return json.loads(body.decode('utf-8'))
+            except ConnectionError as e:
+                self.close()
+                if reused and attempt == 0:
+                    continue
+                log.error('Data is not retrieved. Error: {}\nURL: http://{}:{}{}\n'.format(e, self.host, self.port, self.path))
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                self.close()
+                log.error('Data is not retrieved. Error: {}\nURL: http://{}:{}{}\n'.format(e, self.host, self.port, self.path))
+            return None
+
 
-    o = urlparse('http://{host}:{port}/{url}'.format(**kw))
-    host, port = o.scheme, o.port
-    url = o.geturl()
-    resp = None
+class CcMinerClient(SocketClient):
+    """
+    ccminer API: plain text command, the reply is "|" separated records of
+    "key=value;" pairs terminated by a NUL byte. ccminer closes the
+    connection after each reply, then the next query reconnects. A server
+    which keeps the connection open is reused.
+    """
+    def read_reply(self, deadline):
+        while b'\0' not in self.buf:
+            try:
+                self.buf += self.recv(deadline)
+            except ConnectionResetError:
+                if not self.buf:
+                    raise
+                self.close()
+                reply, self.buf = self.buf, b''
+                return reply
+        reply, self.buf = self.buf.split(b'\0', 1)
+        return reply
+
+    def parse_reply(self, reply):
+        records = []
+        for part in reply.decode('utf-8', 'replace').split('|'):
+            record = dict(x.split('=', 1) for x in part.split(';') if '=' in x)
+            if record:
+                records.append(record)
+        return records
+
+    def query(self, command):
+        for attempt in range(2):
+            reused = self.sock is not None
+            if not self.connect():
+                return None
 
-    try:
-        resp = urllib.request.urlopen(url, timeout=2).read().decode('utf-8')
-    except (HTTPError, URLError) as error:
-        log.error('Data is not retrieved. Error: {}\nURL: {}\n'.format(error, url))
-    except timeout:
-        log.error('Time out. URL: {}\n'.format(url))
-    return resp
+            try:
+                self.sock.sendall(command.encode('utf-8'))
+                records = self.parse_reply(self.read_reply(time.monotonic() + self.timeout))
+                self.ok()
+                return records
+            except ConnectionError as e:
+                if reused and attempt == 0:
+                    self.close()
+                    continue
+                self.failed(e)
+            except OSError as e:
+                self.failed(e)
+            return None
 
 
 class BaseMiner():
-    def sys_reboot(self, delay=args.sys_reboot_delay, fake=False):
-        cmd = 'sudo reboot -dnf'
-        write_log(parse_dmesg())
+    """
+    Failures go through a recovery ladder: miner RPC restart, miner process
+    restart, GPU reset and only then a system reboot. A rung is skipped if it
+    is not available. After an action the miner gets its cooldown to recover,
+    the action helped if the miner is healthy when the cooldown ends, another
+    failure after the cooldown escalates to the next rung. A failure which
+    comes back later goes to the next rung too, the ladder starts over only
+    after `--recovery-reset-after` seconds without failures.
+    """
+    RECOVERY_LADDER = ('rpc_restart', 'proc_restart', 'gpu_reset', 'reboot')
+
+    def __init__(self):
+        self.recovery_cooldown = dict(
+            rpc_restart=args.rpc_restart_cooldown,
+            proc_restart=args.proc_restart_cooldown,
+            gpu_reset=args.gpu_reset_cooldown,
+            reboot=5 * 60,
+        )
+        self.recovery_level = 0
+        self.recovery_action = None
+        self.recovery_ts = 0
+        self.recovery_relapsed = False
+        self.failure_ts = None
 
-        log.warning('System reboot in {} seconds ...'.format(delay))
-        time.sleep(delay)
-        if not fake:
-            os.system(cmd)
-        else:
-            log.debug(cmd)
+    def rpc_restart(self):
+        return None
+
+    def proc_restart(self):
+        return self.run_recovery_cmd(args.miner_restart_cmd)
+
+    def gpu_reset(self):
+        return self.run_recovery_cmd(args.gpu_reset_cmd)
+
+    def run_recovery_cmd(self, cmd, timeout=120):
+        """
+        None if the command is not configured, else True on exit code 0
+        """
+        import subprocess
+
+        if not cmd:
+            return None
+
+        log.warning('Running \"{}\"'.format(cmd))
+        try:
+            proc = subprocess.run(cmd, shell=True, timeout=timeout, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except subprocess.TimeoutExpired:
+            log.error('Command \"{}\" timed out after {} seconds'.format(cmd, timeout))
+            return False
+        if proc.returncode != 0:
+            log.error('Command \"{}\" failed with code {}: {}'.format(cmd, proc.returncode, proc.stdout.decode('utf-8', 'replace').strip()))
+        return proc.returncode == 0
+
+    def reset_state(self):
+        """
+        Drop collected stats after a recovery action, the checks start over
+        """
+        self.watchdog_start_time = time.monotonic()
+
+    def recover(self, reason, delay=args.sys_reboot_delay):
+        now = time.monotonic()
+        self.failure_ts = now
+        if self.recovery_action is not None:
+            cooldown = self.recovery_cooldown[self.recovery_action]
+            if now - self.recovery_ts < cooldown:
+                self.recovery_relapsed = True
+                log.warning('{}; waiting for {} to take effect ({} seconds left)'.format(
+                    reason, self.recovery_action, int(cooldown - (now - self.recovery_ts))
+                ))
+                return
+            write_event('Recovery: {} did not help: {}'.format(self.recovery_action, reason))
+            self.recovery_level += 1
+
+        while self.recovery_level < len(self.RECOVERY_LADDER) - 1:
+            action = self.RECOVERY_LADDER[self.recovery_level]
+            log.warning('{}; trying {}'.format(reason, action))
+            result = getattr(self, action)()
+
+            if result:
+                write_event('Recovery: {} after: {}'.format(action, reason))
+                self.recovery_action = action
+                self.recovery_ts = time.monotonic()
+                self.recovery_relapsed = False
+                self.reset_state()
+                return
+            if result is not None:
+                write_event('Recovery: {} failed: {}'.format(action, reason))
+            self.recovery_level += 1
+
+        write_event('Recovery: reboot after: {}'.format(reason))
+        # normally does not return, if it does the reboot is retried after the cooldown
+        self.recovery_level = len(self.RECOVERY_LADDER) - 1
+        self.recovery_action = 'reboot'
+        self.recovery_ts = time.monotonic()
+        self.recovery_relapsed = False
+        self.sys_reboot(delay)
+
+    def recovered(self):
+        """
+        Called on a healthy tick
+        """
+        now = time.monotonic()
+        if self.recovery_action is not None:
+            if now - self.recovery_ts < self.recovery_cooldown[self.recovery_action]:
+                return
+            if self.recovery_relapsed:
+                log.info('Miner is healthy again after {}'.format(self.recovery_action))
+                write_event('Recovery: {} did not hold, the miner failed during the cooldown'.format(self.recovery_action))
+            else:
+                log.info('Miner recovered after {}'.format(self.recovery_action))
+                write_event('Recovery: {} helped'.format(self.recovery_action))
+            # if the failure comes back, the same action is not tried again
+            self.recovery_level = min(self.recovery_level + 1, len(self.RECOVERY_LADDER) - 1)
+            self.recovery_action = None
+
+        if self.recovery_level and now - self.failure_ts >= args.recovery_reset_after:
+            log.info('No failures for {} seconds, recovery starts over from {}'.format(
+                int(now - self.failure_ts), self.RECOVERY_LADDER[0]
+            ))
+            write_event('Recovery: ladder reset')
+            self.recovery_level = 0
+
+    def sys_reboot(self, delay=args.sys_reboot_delay, fake=False):
+        sys_reboot(delay, fake)
 
 
 class EthMiner(BaseMiner):
     def __init__(self, minimal_hashrate, host, port, url=''):
+        super().__init__()
         self.host = host
         self.port = port
         self.minimal_hashrate = minimal_hashrate
@@ -126,17 +605,17 @@ class EthMiner(BaseMiner):
         self.ETHMINER_API_KEYS = ('stat', 'restart')
         self.ETHMINER_API_VALUES = ('miner_getstat1', 'miner_restart')
         self.ETHMINER_API = dict(zip(self.ETHMINER_API_KEYS, self.ETHMINER_API_VALUES))
-        self.ETHMINER_TPL = dict(method='', jsonrpc='2.0', id=0)
+        self.rpc = JsonRpcClient(host, port)
 
         self.HASHRATE_STAT = []
         self.HASHRATE_EMPTY = []
         self.HASHRATE_STAT_SAMPLES = 16
 
         self.watchdog_uptime = 0
-        self.watchdog_start_time = datetime.datetime.now()
+        self.watchdog_start_time = time.monotonic()
 
-        self.timer1_prev = datetime.datetime.now()
-        self.timer1_now = datetime.datetime.now()
+        self.timer1_prev = time.monotonic()
+        self.timer1_now = time.monotonic()
 
         self.total_hashrate = 0
         self.valid = 0
@@ -145,23 +624,14 @@ class EthMiner(BaseMiner):
         self.average_hashrate = 0
         self.share_rate = 0
 
-    def send_json(self, action, nc_delay=1):
-        out = None
+    def send_json(self, action):
+        resp = None
 
         if action in self.ETHMINER_API.keys():
-            self.ETHMINER_TPL.update(dict(method=self.ETHMINER_API.get(action)))
-            eth_kw = dict(
-                json_data=json.dumps(self.ETHMINER_TPL),
-                host=self.host,
-                port=self.port,
-                nc_delay=nc_delay
-            )
-            eth_cmd = 'echo \'{json_data}\' | nc {host} {port} -w {nc_delay}'.format(**eth_kw)
-            out = run_proc(eth_cmd)
+            resp = self.rpc.call(self.ETHMINER_API.get(action))
 
-        if out:
-            data = json.loads(out.decode('utf-8'))['result']
-            log.debug(eth_cmd)
+        if resp and 'result' in resp:
+            data = resp['result']
             log.debug(data)
             return data
         else:
@@ -169,16 +639,16 @@ class EthMiner(BaseMiner):
             return None
 
     def watchdog(self):
-        self.timer1_now = datetime.datetime.now()
-        self.watchdog_uptime = int((datetime.datetime.now() - self.watchdog_start_time).seconds / 60)
+        self.timer1_now = time.monotonic()
+        self.watchdog_uptime = int((time.monotonic() - self.watchdog_start_time) / 60)
 
         miner_data = self.send_json(action=self.ETHMINER_API_KEYS[0])
 
         stat_isfull = len(self.HASHRATE_STAT) > self.HASHRATE_STAT_SAMPLES
         empty_isfull = len(self.HASHRATE_EMPTY) > self.HASHRATE_STAT_SAMPLES
 
-        if (self.timer1_now - self.timer1_prev).seconds > 60:
-            self.timer1_prev = datetime.datetime.now()
+        if self.timer1_now - self.timer1_prev > 60:
+            self.timer1_prev = time.monotonic()
             pass
 
         if stat_isfull:
@@ -201,12 +671,12 @@ class EthMiner(BaseMiner):
                 self.HASHRATE_EMPTY.append(1)
 
         if all([stat_isfull, self.average_hashrate < self.minimal_hashrate, self.valid > 10]):
-            log.warning('Average hashrate {} lower than {}'.format(self.average_hashrate, self.minimal_hashrate))
-            self.sys_reboot()
-
-        if all([self.watchdog_uptime >= 3, empty_isfull]):
+            self.recover('Average hashrate {} lower than {}'.format(self.average_hashrate, self.minimal_hashrate))
+        elif all([self.watchdog_uptime >= 3, empty_isfull]):
             log.error('Miner is down!')
-            self.sys_reboot(30)
+            self.recover('Miner API is down', 30)
+        elif miner_data and self.total_hashrate >= self.minimal_hashrate:
+            self.recovered()
 
         if args.debug:
             log.debug(self.HASHRATE_STAT)
@@ -221,6 +691,17 @@ class EthMiner(BaseMiner):
             log.info('Watchdog uptime: {}'.format(self.watchdog_uptime))
             log.info('Average hashrate: {}; Minimal reboot hashrate: {}; Share rate: {}/min\n'.format(self.average_hashrate, self.minimal_hashrate, self.share_rate))
 
+    def rpc_restart(self):
+        # ethminer replies {"result": true}, false or no reply means the restart was not done
+        return bool(self.send_json(action='restart'))
+
+    def reset_state(self):
+        super().reset_state()
+        self.HASHRATE_STAT = []
+        self.HASHRATE_EMPTY = []
+        self.total_hashrate = self.valid = self.rejected = 0
+        self.average_hashrate = 0
+
     def fix_types(self):
         self.miner_uptime = int(self.miner_uptime)
         self.valid, self.rejected = int(self.valid), int(self.rejected)
@@ -229,42 +710,62 @@ class EthMiner(BaseMiner):
 
 class EwbfMiner(BaseMiner):
     def __init__(self, minimal_hashrate, host, port, url=''):
+        super().__init__()
         self.host = host
         self.port = port
         self.url = url
         self.minimal_hashrate = minimal_hashrate
 
         self.watchdog_uptime = 0
-        self.watchdog_start_time = datetime.datetime.now()
+        self.watchdog_start_time = time.monotonic()
 
+        self.api = HttpJsonClient(host, port, url)
         self.miner_data = {}
-        self.miner_data_ts = datetime.datetime.now()
+        self.miner_data_keys = ('busid', 'name', 'hashrate', 'power', 'accepted', 'rejected')
+        self.miner_data_ts = time.monotonic()
+        self.miner_data_ts_delta = 0
         self.HASHRATE_EMPTY = []
         self.HASHRATE_STAT_SAMPLES = 16
 
         self.cur_hashrate = 0
         self.total_power = 0
+        self.total_accepted = 0
+        self.total_rejected = 0
         self.miner_start_time = datetime.datetime.now()
 
     def get_data(self):
-        self.miner_data_ts_delta = datetime.datetime.now() - self.miner_data_ts
-        data = get_json_data(host=self.host, port=self.port, url=self.url)
+        self.miner_data_ts_delta = int(time.monotonic() - self.miner_data_ts)
+        data = self.api.get()
 
         if data:
-            data = json.loads(data)
-            result = data.get('result')
+            seen = set()
+            self.cur_hashrate = self.total_power = self.total_accepted = self.total_rejected = 0
+
+            for x in data.get('result'):
+                busid = x.get('busid')
+                seen.add(busid)
+
+                # records are created once per card and updated in place
+                record = self.miner_data.get(busid)
+                if record is None:
+                    record = self.miner_data[busid] = dict.fromkeys(self.miner_data_keys)
+                    record['busid'] = busid
+                record['name'] = x.get('name')
+                record['hashrate'] = x.get('speed_sps')
+                record['power'] = x.get('gpu_power_usage')
+                record['accepted'] = x.get('accepted_shares')
+                record['rejected'] = x.get('rejected_shares')
+
+                self.cur_hashrate += record['hashrate']
+                self.total_power += record['power']
+                self.total_accepted += record['accepted']
+                self.total_rejected += record['rejected']
+
+            for busid in [k for k in self.miner_data if k not in seen]:
+                del self.miner_data[busid]
 
-            self.cur_hashrate = sum([x.get('speed_sps') for x in result])
-            self.total_power = sum([x.get('gpu_power_usage') for x in result])
-            self.total_accepted = sum([x.get('accepted_shares') for x in result])
-            self.total_rejected = sum([x.get('rejected_shares') for x in result])
             self.miner_start_time = datetime.datetime.fromtimestamp(data.get('start_time'))
-            self.miner_data_ts = datetime.datetime.now()
-            self.miner_data = {x.get('busid'):
-                dict(
-                    hashrate=x.get('speed_sps'), busid=x.get('busid'), name=x.get('name'),
-                    accepted=x.get('accepted_shares'), rejected=x.get('rejected_shares'),
-                ) for x in result}
+            self.miner_data_ts = time.monotonic()
             log.info('Miner API is alive')
             log.info(self.miner_data)
             log.debug(data)
@@ -272,15 +773,15 @@ class EwbfMiner(BaseMiner):
             log.info('Accepted: {}; Rejected {}\n'.format(self.total_accepted, self.total_rejected))
         else:
             data = None
-            self.miner_data = {}
+            self.miner_data.clear()
             log.error('Miner API is down?')
         return data
 
     def watchdog(self):
-        self.watchdog_uptime = int((datetime.datetime.now() - self.watchdog_start_time).seconds)
+        self.watchdog_uptime = int(time.monotonic() - self.watchdog_start_time)
         self.get_data()
 
-        log.info('Miner get_data ts (delta seconds): {}'.format(self.miner_data_ts_delta.seconds))
+        log.info('Miner get_data ts (delta seconds): {}'.format(self.miner_data_ts_delta))
 
         if self.watchdog_uptime >= 3 * 60:
             if self.cur_hashrate < self.minimal_hashrate:
@@ -290,131 +791,559 @@ class EwbfMiner(BaseMiner):
             else:
                 self.HASHRATE_EMPTY = []
 
-            if any([self.miner_data_ts_delta.seconds >= (3 * 60), len(self.HASHRATE_EMPTY) >= self.HASHRATE_STAT_SAMPLES]):
-                self.sys_reboot(30)
+            if self.miner_data_ts_delta >= (3 * 60):
+                self.recover('No miner data for {} seconds'.format(self.miner_data_ts_delta), 30)
+            elif len(self.HASHRATE_EMPTY) >= self.HASHRATE_STAT_SAMPLES:
+                self.recover('Hashrate lower than {} for {} samples'.format(self.minimal_hashrate, len(self.HASHRATE_EMPTY)), 30)
+            elif not self.HASHRATE_EMPTY:
+                self.recovered()
 
+    def reset_state(self):
+        super().reset_state()
+        self.HASHRATE_EMPTY = []
+        self.miner_data_ts = time.monotonic()
 
-class GenericMiner(BaseMiner):
-    def __init__(self, minimal_gpu_load):
-        self.min_load = minimal_gpu_load
+
+class CcMiner(BaseMiner):
+    """
+    Total and per-GPU hashrate (kH/s) from the ccminer "summary" and
+    "threads" API commands
+    """
+    def __init__(self, minimal_hashrate, host, port, url='', minimal_gpu_hashrate=None, load_window=16, load_below=16):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.minimal_hashrate = minimal_hashrate
+        self.minimal_gpu_hashrate = minimal_gpu_hashrate
+        self.load_window = load_window
+        self.load_below = min(load_below, load_window)
 
         self.sys_reboot_delay = 3 * 60 # in seconds
         self.watchdog_uptime = 0
-        self.watchdog_start_time = datetime.datetime.now()
+        self.watchdog_start_time = time.monotonic()
 
-        self.smi_key_list = ('utilization.gpu', 'temperature.gpu', 'power.draw')
-        self.data = []
-        self.data_ts = datetime.datetime.now()
-        self.data_ts_delta = datetime.datetime.now()
-        self.proc = self.run_smi()
+        self.api = CcMinerClient(host, port)
+        self.summary = {}
+        self.gpu_data = OrderedDict()
+        self.miner_data_ts = time.monotonic()
+        self.miner_data_ts_delta = 0
+
+        self.HASHRATE = dict()
+        self.HASHRATE_EMPTY = []
+        self.HASHRATE_STAT_SAMPLES = 16
 
-        self.MIN_LOAD = []
-        self.MIN_LOAD_SAMPLES = 16
+        self.cur_hashrate = 0
 
-    def run_smi(self):
-        import subprocess
+    def to_float(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
 
-        key_list = ','.join(self.smi_key_list)
-        proc = subprocess.Popen(
-            ['nvidia-smi', '--query-gpu={}'.format(key_list), '--format=csv,noheader,nounits'],
-            stderr=subprocess.PIPE, stdout=subprocess.PIPE
-        )
-        return proc
+    def get_data(self):
+        self.miner_data_ts_delta = int(time.monotonic() - self.miner_data_ts)
+        summary = self.api.query('summary')
+        threads = self.api.query('threads') if summary else None
+
+        if not summary or threads is None:
+            self.gpu_data.clear()
+            self.cur_hashrate = 0
+            log.error('Miner API is down?')
+            return None
+
+        self.summary = summary[0]
+        self.cur_hashrate = self.to_float(self.summary.get('KHS'))
+
+        self.gpu_data.clear()
+        for x in threads:
+            if 'GPU' not in x:
+                continue
+            idx = int(x['GPU'])
+            self.gpu_data[idx] = dict(
+                name=x.get('CARD'), bus=x.get('BUS'),
+                hashrate=self.to_float(x.get('KHS')), temp=self.to_float(x.get('TEMP')),
+                power=self.to_float(x.get('POWER')) / 1000, accepted=int(x.get('ACC', 0)), rejected=int(x.get('REJ', 0)),
+            )
+
+        self.miner_data_ts = time.monotonic()
+        log.info('Miner API is alive')
+        log.info('; '.join('GPU{:02d}: {} kH/s'.format(k, v['hashrate']) for k, v in self.gpu_data.items()))
+        log.info('Total hashrate: {} kH/s; Accepted: {}; Rejected {}\n'.format(
+            self.cur_hashrate, self.summary.get('ACC'), self.summary.get('REJ')
+        ))
+        return self.gpu_data
+
+    def get_gpu_threshold(self):
+        if self.minimal_gpu_hashrate is not None:
+            return self.minimal_gpu_hashrate
+        gpus = int(self.to_float(self.summary.get('GPUS'))) or len(self.gpu_data)
+        return self.minimal_hashrate / gpus if gpus else 0
+
+    def check_gpus(self):
+        threshold = self.get_gpu_threshold()
+        for idx, x in self.gpu_data.items():
+            if idx not in self.HASHRATE:
+                self.HASHRATE[idx] = LoadWindow(self.load_window, threshold)
+            window = self.HASHRATE[idx]
+            window.threshold = threshold
+            window.push(x['hashrate'])
+            if x['hashrate'] < threshold:
+                log.warning('GPU{:02d} hashrate {} < {} ({} of last {} samples)'.format(idx, x['hashrate'], round(threshold, 2), window.below, window.count))
+        return [idx for idx, window in self.HASHRATE.items() if window.below >= self.load_below]
+
+    def reset_state(self):
+        super().reset_state()
+        self.HASHRATE.clear()
+        self.HASHRATE_EMPTY = []
+        self.miner_data_ts = time.monotonic()
+
+    def watchdog(self):
+        self.watchdog_uptime = int(time.monotonic() - self.watchdog_start_time)
+        data = self.get_data()
+
+        if self.watchdog_uptime < self.sys_reboot_delay:
+            log.info('Watchdog uptime is too low. All checks will be activated in {} seconds'.format(self.sys_reboot_delay - self.watchdog_uptime))
+            return
 
-    def update_data(self):
-        self.proc.poll()
-        if self.proc.poll() == 0 and self.proc.returncode == 0:
+        if data:
+            if self.cur_hashrate < self.minimal_hashrate:
+                log.warning('Current hashrate {} < {} (minimal hashrate)'.format(self.cur_hashrate, self.minimal_hashrate))
+                self.HASHRATE_EMPTY.append(1)
+            else:
+                self.HASHRATE_EMPTY = []
+            low_gpus = self.check_gpus()
+        else:
+            low_gpus = []
+
+        if self.miner_data_ts_delta >= self.sys_reboot_delay:
+            self.recover('No miner data for {} seconds'.format(self.miner_data_ts_delta), 30)
+        elif len(self.HASHRATE_EMPTY) >= self.HASHRATE_STAT_SAMPLES:
+            self.recover('Hashrate lower than {} for {} samples'.format(self.minimal_hashrate, len(self.HASHRATE_EMPTY)), 30)
+        elif low_gpus:
+            self.recover('Hashrate lower than {} kH/s in {} of last {} samples on {}'.format(
+                round(self.get_gpu_threshold(), 2), self.load_below, self.load_window, ', '.join('GPU{:02d}'.format(x) for x in sorted(low_gpus))
+            ), 30)
+        elif data and not self.HASHRATE_EMPTY and not any(x.below for x in self.HASHRATE.values()):
+            self.recovered()
+
+
+class LoadWindow():
+    """
+    Last `size` load samples of one GPU in a ring buffer.
+    The sum and the number of samples below the threshold are kept up to date
+    on every push, so the average and the "N of last M" check are O(1).
+    Every sample keeps its own below flag, the threshold may change between
+    pushes without breaking the count.
+    """
+    def __init__(self, size, threshold):
+        self.size = size
+        self.threshold = threshold
+        self.ring = [0] * size
+        self.below_ring = [False] * size
+        self.pos = 0
+        self.count = 0
+        self.total = 0
+        self.below = 0
+
+    def push(self, value):
+        if self.count == self.size:
+            self.total -= self.ring[self.pos]
+            self.below -= self.below_ring[self.pos]
+        else:
+            self.count += 1
+        is_below = value < self.threshold
+        self.ring[self.pos] = value
+        self.below_ring[self.pos] = is_below
+        self.pos = (self.pos + 1) % self.size
+        self.total += value
+        self.below += is_below
+
+    def average(self):
+        return round(self.total / self.count, 2) if self.count else 0
+
+
+class SmiSampler(threading.Thread):
+    """
+    Keeps one `nvidia-smi -lms` process running and stores the latest
+    sample of every GPU. The process is started again if it exits,
+    until stop() is called.
+    """
+    def __init__(self, key_list, interval, gpus=None):
+        super().__init__(daemon=True)
+        self.key_list = ('index',) + tuple(key_list)
+        self.interval = interval
+        self.gpus = gpus
+        self.respawn_delay = 5
+
+        self.running = True
+        self.proc = None
+        self.lock = threading.Lock()
+        self.samples = dict()
+        self.seq = 0
+
+    def get_cmd(self):
+        cmd = [
+            'nvidia-smi',
+            '--query-gpu={}'.format(','.join(self.key_list)),
+            '--format=csv,noheader,nounits',
+            '-lms', str(max(int(self.interval * 1000), 100)),
+        ]
+        if self.gpus:
+            cmd.append('--id={}'.format(','.join(str(x) for x in self.gpus)))
+        return cmd
+
+    def parse_line(self, line):
+        values = [x.strip() for x in line.split(',')]
+        if len(values) != len(self.key_list):
+            return None
+        data = dict(zip(self.key_list, values))
+        try:
+            data['index'] = int(data['index'])
+        except ValueError:
+            return None
+        return data
+
+    def read_proc(self, proc):
+        for line in proc.stdout:
+            data = self.parse_line(line)
+            if data is None:
+                continue
+            with self.lock:
+                self.seq += 1
+                data['seq'] = ('smi', self.seq)
+                data['ts'] = time.monotonic()
+                self.samples[data['index']] = data
+
+    def run(self):
+        import subprocess
+
+        while self.running:
             try:
-                raw_data = (
-                    dict(zip(self.smi_key_list, x.split(', '))) for x in self.proc.stdout.read().decode('utf-8').split('\n') if x
+                self.proc = proc = subprocess.Popen(
+                    self.get_cmd(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
                 )
-                data = tuple(raw_data)
-                self.data = data
-                self.data_ts = datetime.datetime.now()
-            except Exception as e:
-                log.error('Error in update_data')
-                log.error(e)
+            except OSError as e:
+                log.error('Can not start nvidia-smi: {}'.format(e))
+            else:
+                if not self.running:
+                    proc.terminate()
+                self.read_proc(proc)
+                proc.wait()
+                if not self.running:
+                    break
+                log.error('nvidia-smi exited with code {}, restarting'.format(proc.returncode))
+            time.sleep(self.respawn_delay)
+
+    def stop(self):
+        self.running = False
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+
+    def get_samples(self, max_age=None):
+        """
+        Samples older than max_age seconds are dropped, a GPU which fell out
+        of nvidia-smi output must not keep its last sample forever
+        """
+        with self.lock:
+            if max_age is not None:
+                min_ts = time.monotonic() - max_age
+                for idx in [idx for idx, x in self.samples.items() if x['ts'] < min_ts]:
+                    del self.samples[idx]
+            return dict(self.samples)
+
+
+class GenericMiner(BaseMiner):
+    def __init__(self, minimal_gpu_load, gpus=None, interval=1, load_window=16, load_below=16):
+        super().__init__()
+        self.min_load = minimal_gpu_load
+        self.gpus = gpus
+        self.load_window = load_window
+        self.load_below = min(load_below, load_window)
+
+        self.sys_reboot_delay = 3 * 60 # in seconds
+        self.watchdog_uptime = 0
+        self.watchdog_start_time = time.monotonic()
+
+        self.smi_key_list = ('utilization.gpu', 'temperature.gpu', 'power.draw')
+        self.data = dict()
+        self.data_ts = time.monotonic()
+        self.data_ts_delta = 0
+        # last sample time of every GPU seen so far, a GPU missing from the data keeps aging here
+        self.gpu_ts = dict.fromkeys(gpus or (), self.data_ts)
+
+        self.LOAD = dict()
+        self.last_seq = dict()
+
+        # GPU data comes from the api.py telemetry file, own nvidia-smi is started only without it
+        self.telemetry = TelemetryReader(args.shm_path, max_age=args.shm_max_age) if args.shm_path else None
+        self.telemetry_keys = dict(zip(self.smi_key_list, ('core_load', 'temp', 'power_current')))
+        self.interval = interval
+        self.sample_max_age = max(5 * interval, 5)
+        self.sampler = None
+
+    def read_telemetry(self):
+        if self.telemetry is None:
+            return None
+
+        telemetry = self.telemetry.read()
+        if telemetry is None:
+            return None
+        cards, gen, ts = telemetry
+        if time.monotonic() - ts > self.sample_max_age:
+            # the collector in api.py is behind, own nvidia-smi gives fresher samples
+            return None
+
+        samples = dict()
+        for card in cards:
+            if self.gpus and card['index'] not in self.gpus:
+                continue
+            data = dict((k, card.get(v)) for k, v in self.telemetry_keys.items())
+            data.update(index=card['index'], seq=('shm', gen), ts=ts)
+            samples[card['index']] = data
+        return samples
+
+    def get_samples(self):
+        samples = self.read_telemetry()
+        if samples is not None:
+            if self.sampler is not None:
+                log.info('Telemetry from api.py is back, stopping nvidia-smi')
+                self.sampler.stop()
+                self.sampler = None
+            return samples
+
+        if self.sampler is None:
+            log.info('No telemetry from api.py, starting nvidia-smi')
+            self.sampler = SmiSampler(self.smi_key_list, self.interval, self.gpus)
+            self.sampler.start()
+        return self.sampler.get_samples(self.sample_max_age)
+
+    def gpu_name(self, idx):
+        return 'GPU{0:02d}'.format(idx)
 
     def print_load(self):
         k = self.smi_key_list[0]
-        l = ['GPU{0:02d}: {1}'.format(idx, x.get(k)) for idx, x in enumerate(self.data)]
+        l = ['{0}: {1}'.format(self.gpu_name(idx), x.get(k)) for idx, x in sorted(self.data.items())]
         log.info('GPU load (%); {}'.format('; '.join(l)))
 
     def get_or_update_data(self):
-        self.data_ts_delta = datetime.datetime.now() - self.data_ts
-        if not self.data:
-            self.update_data()
-        else:
+        self.data = self.get_samples()
+        for idx, x in self.data.items():
+            self.gpu_ts[idx] = x['ts']
+        if self.data:
             self.print_load()
-            self.data = []
-            self.proc = self.run_smi()
-        # log.debug('Last data ts (delta seconds): {}'.format(self.data_ts_delta.seconds))
+        if self.gpu_ts:
+            # the oldest GPU counts, healthy cards must not hide a dead one
+            self.data_ts = min(self.gpu_ts.values())
+        self.data_ts_delta = int(time.monotonic() - self.data_ts)
+
+    def get_missing_gpus(self):
+        return sorted(idx for idx in self.gpu_ts if idx not in self.data)
 
     def draw_min_load(self):
-        bar_cur_len = len(self.MIN_LOAD)
-        bar_max_len = self.MIN_LOAD_SAMPLES - bar_cur_len
-        if bar_cur_len <= self.MIN_LOAD_SAMPLES:
-            progress_bar = '[{}{}]'.format(
-                ''.join(['|' for x in range(bar_cur_len)]),
-                ''.join(['.' for x in range(bar_max_len)]),
-            )
-            log.warning(progress_bar)
+        for idx, window in sorted(self.LOAD.items()):
+            if window.below:
+                progress_bar = '[{}{}]'.format('|' * window.below, '.' * (self.load_below - window.below))
+                log.warning('{} {} {} of last {} samples below {}%'.format(
+                    self.gpu_name(idx), progress_bar, window.below, window.count, self.min_load
+                ))
 
     def check_load(self):
-        if not self.data:
-            return None
-
+        """
+        Feed only fresh samples to the windows, a stuck sampler must not fill them
+        """
         k = self.smi_key_list[0]
-        for idx, x in enumerate(self.data):
-            cur_load = int(x.get(k, 0))
+        for idx, x in self.data.items():
+            if self.last_seq.get(idx) == x['seq']:
+                continue
+            self.last_seq[idx] = x['seq']
+
+            try:
+                cur_load = int(x.get(k) or 0)
+            except ValueError:
+                cur_load = 0
+
+            if idx not in self.LOAD:
+                self.LOAD[idx] = LoadWindow(self.load_window, self.min_load)
+            self.LOAD[idx].push(cur_load)
 
-            gpu_name = 'GPU{idx:02d}'.format(idx=idx)
             if cur_load < self.min_load:
-                log.warning('Current {gpu_name} load (%) {load} < {min_load} (minimal load)'.format(gpu_name=gpu_name, load=cur_load, min_load=self.min_load))
-                self.MIN_LOAD.append(dict(name=gpu_name, load=cur_load))
+                log.warning('Current {gpu_name} load (%) {load} < {min_load} (minimal load)'.format(gpu_name=self.gpu_name(idx), load=cur_load, min_load=self.min_load))
+
+    def reset_state(self):
+        super().reset_state()
+        self.LOAD.clear()
+        self.data_ts = time.monotonic()
+        self.gpu_ts = dict.fromkeys(self.gpu_ts, self.data_ts)
+
+    def get_low_load_gpus(self):
+        return [idx for idx, window in self.LOAD.items() if window.below >= self.load_below]
 
     def watchdog(self):
-        self.watchdog_uptime = int((datetime.datetime.now() - self.watchdog_start_time).seconds)
+        self.watchdog_uptime = int(time.monotonic() - self.watchdog_start_time)
         self.get_or_update_data()
 
         if self.watchdog_uptime >= self.sys_reboot_delay:
             self.check_load()
             self.draw_min_load()
+            low_load_gpus = self.get_low_load_gpus()
+            missing_gpus = self.get_missing_gpus()
+            if missing_gpus:
+                log.warning('No data from {}'.format(', '.join(self.gpu_name(x) for x in missing_gpus)))
 
             if not self.data:
                 log.warning('Data is empty')
-                self.sys_reboot()
-            elif any([self.data_ts_delta.seconds >= self.sys_reboot_delay, len(self.MIN_LOAD) >= self.MIN_LOAD_SAMPLES * len(self.data)]):
-                log.info('Current gpu load lower than {}%'.format(self.min_load))
-                self.sys_reboot(30)
+                self.recover('No GPU load data')
+            elif self.data_ts_delta >= self.sys_reboot_delay:
+                self.recover('No GPU load data for {} seconds from {}'.format(
+                    self.data_ts_delta, ', '.join(self.gpu_name(x) for x in missing_gpus) or 'all GPUs'
+                ), 30)
+            elif low_load_gpus:
+                self.recover('GPU load lower than {}% in {} of last {} samples on {}'.format(
+                    self.min_load, self.load_below, self.load_window, ', '.join(self.gpu_name(x) for x in sorted(low_load_gpus))
+                ), 30)
+            elif not missing_gpus and not any(x.below for x in self.LOAD.values()):
+                self.recovered()
         else:
             log.info('Watchdog uptime is too low. All checks will be activated in {} seconds'.format(self.sys_reboot_delay - self.watchdog_uptime))
 
 
-miner_d = MINER.get(args.miner_name)
-miner_class_name = miner_d.get('class_name')
-miner_class = eval(miner_class_name)
+class WatchdogJob():
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.future = None
 
-if args.miner_name == 'generic':
-    miner = miner_class(
-        minimal_gpu_load=args.minimal_gpu_load,
-    )
-else:
-    if not args.miner_api_port:
-        miner_port = miner_d.get('port')
-    else:
-        miner_port = args.miner_api_port
-    miner_url = miner_d.get('url')
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.func()
+        except Exception as e:
+            log.exception('{} watchdog error: {}'.format(self.name, e))
+        log.debug('{} watchdog took {:.3f} seconds'.format(self.name, time.monotonic() - start))
+
+
+class WatchdogScheduler():
+    """
+    Runs several watchdogs in one process, each on its own interval with
+    time.monotonic() deadlines. Every run goes to a worker thread, so a slow
+    miner API does not delay the other checks. A watchdog which is still
+    running at its next deadline is skipped for that tick.
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.pool = ThreadPoolExecutor(max_workers=len(jobs))
+
+    def run(self):
+        now = time.monotonic()
+        queue = [(now, idx) for idx in range(len(self.jobs))]
+        heapq.heapify(queue)
+
+        while True:
+            deadline, idx = queue[0]
+            now = time.monotonic()
+            if deadline > now:
+                time.sleep(deadline - now)
+                continue
+
+            heapq.heappop(queue)
+            job = self.jobs[idx]
+            if job.future is not None and not job.future.done():
+                log.warning('{} watchdog is still running, skipping tick'.format(job.name))
+            else:
+                job.future = self.pool.submit(job.run)
+
+            deadline += job.interval
+            if deadline <= now:
+                deadline = now + job.interval
+            heapq.heappush(queue, (deadline, idx))
+
+
+def parse_gpus(value):
+    """
+    '0-3,6' -> [0, 1, 2, 3, 6]
+    """
+    gpus = []
+    for part in value.split(','):
+        first, _, last = part.partition('-')
+        gpus.extend(range(int(first), int(last or first) + 1))
+    return gpus
+
+
+def make_miner(name, opts):
+    miner_d = MINER.get(name)
+    miner_class = globals()[miner_d.get('class_name')]
+
+    if name == 'generic':
+        gpus = parse_gpus(opts['gpus']) if opts.get('gpus') else None
+        return miner_class(
+            minimal_gpu_load=int(opts.get('minimal_gpu_load', args.minimal_gpu_load)),
+            gpus=gpus,
+            interval=float(opts.get('interval', args.interval)),
+            load_window=int(opts.get('load_window', args.load_window)),
+            load_below=int(opts.get('load_below', args.load_below)),
+        )
 
-    if not args.minimal_hashrate:
-        log.error('--minimal-hashrate is required')
+    minimal_hashrate = opts.get('minimal_hashrate', args.minimal_hashrate)
+    if not minimal_hashrate:
+        log.error('--minimal-hashrate is required for {}'.format(name))
         sys.exit(1)
-    miner = miner_class(
-        minimal_hashrate=args.minimal_hashrate,
-        host=args.miner_api_host, port=miner_port, url=miner_url,
+
+    kw = dict(
+        minimal_hashrate=int(minimal_hashrate),
+        host=opts.get('host', args.miner_api_host),
+        port=int(opts.get('port', miner_d.get('port'))),
+        url=opts.get('url', miner_d.get('url')),
     )
+    if name == 'ccminer':
+        minimal_gpu_hashrate = opts.get('minimal_gpu_hashrate', args.minimal_gpu_hashrate)
+        kw.update(
+            minimal_gpu_hashrate=float(minimal_gpu_hashrate) if minimal_gpu_hashrate is not None else None,
+            load_window=int(opts.get('load_window', args.load_window)),
+            load_below=int(opts.get('load_below', args.load_below)),
+        )
+    return miner_class(**kw)
+
+
+def parse_watch(spec):
+    """
+    ['ethminer', 'port=3333', 'interval=2'] -> ('ethminer', {'port': '3333', 'interval': '2'})
+    """
+    name, opts = spec[0], dict()
+    for token in spec[1:]:
+        key, sep, value = token.partition('=')
+        if not sep or not key:
+            log.error('Bad --watch option \"{}\" for {}, expected KEY=VALUE'.format(token, name))
+            sys.exit(1)
+        opts[key] = value
+    if name not in MINER:
+        log.error('Unknown miner \"{}\", choose from: {}'.format(name, ', '.join(MINER_CHOICES)))
+        sys.exit(1)
+    return name, opts
+
 
+if __name__ == '__main__':
+    if args.watch:
+        watch_list = [parse_watch(x) for x in args.watch]
+    else:
+        opts = dict()
+        if args.miner_api_port:
+            opts['port'] = args.miner_api_port
+        watch_list = [(args.miner_name, opts)]
 
-while True:
-    miner.watchdog()
-    time.sleep(1)
+    jobs = []
+    for idx, (name, opts) in enumerate(watch_list):
+        try:
+            miner = make_miner(name, opts)
+            interval = float(opts.get('interval', args.interval))
+        except ValueError as e:
+            log.error('Bad --watch options for {}: {}'.format(name, e))
+            sys.exit(1)
+        job_name = '{}#{}'.format(name, idx) if len(watch_list) > 1 else name
+        jobs.append(WatchdogJob(job_name, miner.watchdog, interval))
+
+    KMSG = KmsgReader()
+    KMSG.start()
+    jobs.append(WatchdogJob('xid', check_gpu_faults, 1))
+
+    WatchdogScheduler(jobs).run()
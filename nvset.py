@@ -9,9 +9,12 @@ import hashlib
 import time
 import logging as log
 import subprocess
+import shlex
+from concurrent.futures import ThreadPoolExecutor
 
 from app.core import check_python
 from app.settings import API_URL
+from app.shm import SHM_PATH, TelemetryReader
 
 
 check_python()
@@ -22,13 +25,16 @@ import configparser
 
 parser = argparse.ArgumentParser(description='Nvidia GPU setup')
 parser.add_argument('-c', '--config', type=str, required=True, help='For example: -c rig01.conf')
-parser.add_argument('--start-delay', type=int, default=15, help='Add delay if first run')
+parser.add_argument('--start-delay', type=int, default=15, help='Max wait for nvidia-settings on first run')
 parser.add_argument('-M', '--make-config', action='store_true', default=False, help='Make config template')
 parser.add_argument('--nv-set-path', type=str, default='nvidia-settings', help='Path to nvidia-settings')
 parser.add_argument('--nv-smi-path', type=str, default='nvidia-smi', help='Path to nvidia-smi')
 parser.add_argument('--nv-set-env', type=str, nargs='+', default=['DISPLAY=\":0\"', 'XAUTHORITY=\"/var/run/lightdm/root/:0\"'], help='nvidia-settings extra environment variables')
+parser.add_argument('--jobs', type=int, default=4, help='Parallel per-card calls if a batched call fails')
+parser.add_argument('--cmd-timeout', type=int, default=60, help='Max seconds for one nvidia-smi or nvidia-settings call')
 parser.add_argument('--api-url', type=str, default=API_URL, help='API url')
 parser.add_argument('--api-timeout', type=int, default=10, help='API read timeout')
+parser.add_argument('--shm-path', type=str, default=SHM_PATH, help='Telemetry file published by api.py, empty to disable')
 
 # overclock default values
 parser.add_argument('--pl', type=int, default=80, help='Default power limit')
@@ -108,6 +114,21 @@ def read_api(url=args.api_url, debug=args.debug, api_timeout=args.api_timeout):
         return(j)
 
 
+TELEMETRY = TelemetryReader(args.shm_path) if args.shm_path else None
+
+
+def read_telemetry():
+    """
+    Cards from the api.py telemetry file in the API format, read_api() if it is not available
+    """
+    if TELEMETRY is not None and not args.fake:
+        telemetry = TELEMETRY.read()
+        if telemetry is not None:
+            log.debug('Using telemetry from \"{}\"'.format(args.shm_path))
+            return [dict(cards=telemetry[0]), ]
+    return read_api()
+
+
 def gen_conf(fp=args.config):
     config = configparser.ConfigParser()
     config.read(fp)
@@ -136,7 +157,7 @@ def gen_conf(fp=args.config):
 
 
 def set_fan():
-    d = read_api()
+    d = read_telemetry()
     if not d:
         log.error('API data is empty')
         return False
@@ -170,51 +191,166 @@ def set_fan():
     run_proc(cmd_list)
 
 
+def get_nv_set_env():
+    """
+    --nv-set-env values are shell style (DISPLAY=\":0\"), commands run without a shell
+    """
+    env = dict(os.environ)
+    for x in args.nv_set_env:
+        for item in shlex.split(x):
+            k, _, v = item.partition('=')
+            env[k] = v
+    return env
+
+
+def run_cmd(cmd, env=None, timeout=args.cmd_timeout):
+    """
+    (ok, seconds, output) of an argv list, ok is None if the command timed out
+    """
+    start = time.monotonic()
+    log.debug(' '.join(shlex.quote(x) for x in cmd))
+    try:
+        proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        out = 'timed out after {:.1f} seconds'.format(timeout)
+        log.error('\"{}\" {}'.format(' '.join(cmd[:2]), out))
+        return None, time.monotonic() - start, out
+    except OSError as e:
+        return False, time.monotonic() - start, str(e)
+    return proc.returncode == 0, time.monotonic() - start, proc.stdout.decode('utf-8', 'replace').strip()
+
+
+def wait_nv_set(env, timeout=args.start_delay):
+    """
+    Polls nvidia-settings until the X server answers, at most `timeout` seconds
+    """
+    deadline = time.monotonic() + timeout
+    cmd = ['sudo', args.nv_set_path, '-q', 'gpus', '-c', ':0']
+
+    while True:
+        # a hung probe must not outlive the deadline
+        ok, duration, out = run_cmd(cmd, env, timeout=max(deadline - time.monotonic(), 1))
+        if ok:
+            return True
+        if time.monotonic() + 1 > deadline:
+            log.warning('nvidia-settings is not ready after {} seconds: {}'.format(timeout, out))
+            return False
+        time.sleep(1)
+
+
+def get_nv_attr(card):
+    attr = [
+        '[gpu:{index}]/GPUFanControlState=1',                               # gain manual fan control
+        '[fan:{index}]/GPUTargetFanSpeed={fan}',                            # set fan speed
+        '[gpu:{index}]/GPUPowerMizerMode=1',                                # enable PowerMizer (Prefer Maximum Performance)
+        '[gpu:{index}]/GPUGraphicsClockOffset[2]={core}',                   # set core clock (2 - mining edition)
+        '[gpu:{index}]/GPUGraphicsClockOffset[3]={core}',                   # set core clock (3 - desktop edition)
+        '[gpu:{index}]/GPUMemoryTransferRateOffset[2]={mem}',               # set memory clock
+        '[gpu:{index}]/GPUMemoryTransferRateOffset[3]={mem}',               # set memory clock
+    ]
+
+    if args.fan_auto:
+        attr = attr[2:]
+
+    cmd = []
+    for x in attr:
+        cmd += ['-a', x.format(**card)]
+    return cmd
+
+
+def run_batches(batches, report):
+    """
+    One call per batch of cards, a failed batch is retried with one call per card.
+    Both rounds share one pool, at most --jobs commands run at once. A batch
+    which timed out is not retried, the same hang would repeat for every card.
+    """
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(run_cmd, batch_cmd, env) for name, batch_cmd, card_cmds, env in batches]
+
+        retries = []
+        for (name, batch_cmd, card_cmds, env), future in zip(batches, futures):
+            ok, duration, out = future.result()
+            if ok:
+                for index in card_cmds:
+                    report[index][name] = (True, duration, 'batched')
+                continue
+            if ok is None:
+                log.error('Batched {} {}, not retrying per card'.format(name, out))
+                for index in card_cmds:
+                    report[index][name] = (False, duration, out)
+                continue
+
+            log.warning('Batched {} failed ({}), applying per card'.format(name, out))
+            for index, cmd in card_cmds.items():
+                retries.append((name, index, pool.submit(run_cmd, cmd, env)))
+
+        for name, index, future in retries:
+            report[index][name] = future.result()
+
+
 def apply_settings(lst):
     global FIRST_RUN
 
+    start = time.monotonic()
+    env = get_nv_set_env()
+
     if FIRST_RUN:
-        log.info('First run, waiting {} seconds ...'.format(args.start_delay))
-        time.sleep(args.start_delay)
+        log.info('First run, waiting up to {} seconds for nvidia-settings ...'.format(args.start_delay))
+        wait_nv_set(env)
         FIRST_RUN = False
 
     log.info('Applying settings...')
     if not args.debug:
-        os.system('sudo {} -pm ENABLED'.format(args.nv_smi_path)) # set persistent mode on all GPU
+        run_cmd(['sudo', args.nv_smi_path, '-pm', 'ENABLED']) # set persistent mode on all GPU
 
-    for i in lst:
-        i['nv_smi'] = args.nv_smi_path
-        i['nv_set'] = args.nv_set_path
-        if args.nv_set_env:
-            i['env'] = ' '.join(args.nv_set_env)
-
-        nv_attr = [
-            '{env} sudo {nv_set}',
-            '-a \"[gpu:{index}]/GPUFanControlState=1\"',                               # gain manual fan control
-            '-a \"[fan:{index}]/GPUTargetFanSpeed={fan}\"',                            # set fan speed
-            '-a \"[gpu:{index}]/GPUPowerMizerMode=1\"',                                # enable PowerMizer (Prefer Maximum Performance)
-            '-a \"[gpu:{index}]/GPUGraphicsClockOffset[2]={core}\"',                   # set core clock (2 - mining edition)
-            '-a \"[gpu:{index}]/GPUGraphicsClockOffset[3]={core}\"',                   # set core clock (3 - desktop edition)
-            '-a \"[gpu:{index}]/GPUMemoryTransferRateOffset[2]={mem}\"',               # set memory clock
-            '-a \"[gpu:{index}]/GPUMemoryTransferRateOffset[3]={mem}\"',               # set memory clock
-            '-c :0',
-        ]
+    try:
+        cards = [dict(index=int(i['index']), pl=i['pl'], fan=i['fan'], core=i['core'], mem=i['mem']) for i in lst]
+    except (KeyError, ValueError):
+        log.error('Invalid config file \"{}\". Please check key names'.format(args.config))
+        sys.exit(1)
 
-        if args.fan_auto:
-            nv_attr = nv_attr[0:1] + nv_attr[3:]
-
-        try:
-            cmd = (
-                'sudo {nv_smi} -i {index} -pl {pl}'.format(**i),           # set power limit
-                ' '.join(nv_attr).format(**i),
-            )
-            log.debug('; '.join(cmd))
-
-            run_proc(cmd)
-        except KeyError:
-            log.error('Invalid config file \"{}\". Please check key names'.format(args.config))
-            sys.exit(1)
-    log.info('Settings applied...')
+    report = OrderedDict((card['index'], dict()) for card in cards)
+
+    # cards with the same power limit share one nvidia-smi call
+    pl_groups = OrderedDict()
+    for card in cards:
+        pl_groups.setdefault(card['pl'], []).append(card['index'])
+
+    batches = [
+        (
+            'pl',
+            ['sudo', args.nv_smi_path, '-i', ','.join(str(x) for x in indexes), '-pl', str(pl)],
+            OrderedDict((x, ['sudo', args.nv_smi_path, '-i', str(x), '-pl', str(pl)]) for x in indexes),
+            None,
+        ) for pl, indexes in pl_groups.items()
+    ]
+
+    # all cards in one nvidia-settings call
+    nv_set = ['sudo', args.nv_set_path]
+    batches.append((
+        'attr',
+        nv_set + [x for card in cards for x in get_nv_attr(card)] + ['-c', ':0'],
+        OrderedDict((card['index'], nv_set + get_nv_attr(card) + ['-c', ':0']) for card in cards),
+        env,
+    ))
+
+    # power limit groups and nvidia-settings do not depend on each other
+    run_batches(batches, report)
+
+    failed = 0
+    for index, results in report.items():
+        line = '; '.join(
+            '{} {} {:.2f}s{}'.format(name, 'ok' if ok else 'FAILED', duration, ' (batched)' if out == 'batched' else '')
+            for name, (ok, duration, out) in sorted(results.items(), key=lambda x: x[0] != 'pl')
+        )
+        errors = [out for ok, duration, out in results.values() if not ok]
+        if errors:
+            failed += 1
+            log.error('GPU{:02d}: {}; {}'.format(index, line, ' | '.join(errors)))
+        else:
+            log.info('GPU{:02d}: {}'.format(index, line))
+
+    log.info('Settings applied to {} of {} cards in {:.2f} seconds'.format(len(cards) - failed, len(cards), time.monotonic() - start))
 
 
 def run_proc(cmd_list, fake=False):
@@ -0,0 +1,362 @@
+from app.core import check_python
+
+check_python()
+
+import json
+import time
+import random
+import signal
+import argparse
+import threading
+import socketserver
+import logging as log
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+# Example start, ethminer and ewbf APIs with 6 GPUs, GPU 2 drops out at 60 second:
+# python3 simulator.py --miner ethminer ewbf --gpus 6 --dropout 2@60
+# then in another terminal:
+# python3 miner.py --watch ethminer minimal_hashrate=100 --watch ewbf minimal_hashrate=1500 \
+#     --miner-restart-cmd "pkill -HUP -f [s]imulator.py"
+
+SIM_MINERS = ('ethminer', 'ewbf', 'ccminer')
+
+parser = argparse.ArgumentParser(description='Miner API simulator')
+parser.add_argument('--miner', type=str, nargs='+', choices=SIM_MINERS, default=['ethminer'], help='Miner APIs to simulate')
+parser.add_argument('--host', type=str, default='localhost', help='Listen host')
+parser.add_argument('--ethminer-port', type=int, default=3333, help='ethminer JSON-RPC port')
+parser.add_argument('--ewbf-port', type=int, default=42000, help='ewbf HTTP API port')
+parser.add_argument('--ccminer-port', type=int, default=4068, help='ccminer API port')
+parser.add_argument('--gpus', type=int, default=6, help='Number of GPUs')
+parser.add_argument('--hashrate', type=float, nargs='+', default=[30, 450, 20000],
+                    help='Per-GPU hashrate for ethminer (MH/s), ewbf (Sol/s) and ccminer (kH/s)')
+parser.add_argument('--curve', type=str, default='',
+                    help='Hashrate factor curve, points "SECONDS=FACTOR" with linear interpolation, e.g. "0=0.2,30=1,600=1,660=0.5"')
+parser.add_argument('--dropout', type=str, action='append', default=[],
+                    help='GPU hashrate drops to zero, "GPU@START[-END]" in seconds, repeatable. A miner restart ends it')
+parser.add_argument('--hang', type=str, action='append', default=[],
+                    help='API accepts connections but does not reply, "START[-END]" in seconds, repeatable. A miner restart ends it')
+parser.add_argument('--latency', type=float, default=0, help='Reply delay in seconds')
+parser.add_argument('--jitter', type=float, default=0, help='Random extra reply delay in seconds')
+parser.add_argument('--event-log', type=str, help='Append events as JSON lines to this file')
+parser.add_argument('--debug', action='store_true', default=False, help='Debug mode')
+args = parser.parse_args()
+
+if args.debug:
+    LOG_LEVEL = log.DEBUG
+else:
+    LOG_LEVEL = log.INFO
+
+log.basicConfig(format='[%(levelname)s] %(message)s', level=LOG_LEVEL)
+
+
+def parse_window(value):
+    """
+    '60-120' -> (60.0, 120.0), '60' -> (60.0, None)
+    """
+    start, _, end = value.partition('-')
+    return float(start), float(end) if end else None
+
+
+def parse_curve(value):
+    """
+    '0=0.2,30=1' -> [(0.0, 0.2), (30.0, 1.0)]
+    """
+    points = []
+    for part in value.split(','):
+        if part:
+            t, factor = part.split('=')
+            points.append((float(t), float(factor)))
+    return sorted(points)
+
+
+class Rig():
+    """
+    Simulated rig state, shared by all API servers. Time is counted in
+    seconds from the simulator start. Faults which started before the last
+    miner restart are considered fixed by it.
+    """
+    def __init__(self, gpus, curve, dropouts, hangs, event_log=None):
+        self.gpus = gpus
+        self.curve = curve
+        self.dropouts = dropouts
+        self.hangs = hangs
+        self.event_log = event_log
+
+        self.lock = threading.Lock()
+        self.start_ts = time.monotonic()
+        self.start_time = int(time.time())
+        self.restart_t = 0.0
+        self.restarts = 0
+        self.faults = set()
+
+    def now(self):
+        return time.monotonic() - self.start_ts
+
+    def event(self, name, **kw):
+        kw.update(t=round(self.now(), 3), event=name)
+        fields = ' '.join('{}={}'.format(k, v) for k, v in sorted(kw.items()) if k not in ('t', 'event') and v is not None)
+        log.info('[t={:.3f}] {} {}'.format(kw['t'], name, fields).rstrip())
+        if self.event_log:
+            with self.lock:
+                with open(self.event_log, 'a') as f:
+                    f.write(json.dumps(kw) + '\n')
+
+    def is_active(self, window, t):
+        start, end = window
+        return self.restart_t <= start <= t and (end is None or t < end)
+
+    def factor(self, t):
+        if not self.curve:
+            return 1.0
+        if t <= self.curve[0][0]:
+            return self.curve[0][1]
+        for (t0, f0), (t1, f1) in zip(self.curve, self.curve[1:]):
+            if t0 <= t < t1:
+                return f0 + (f1 - f0) * (t - t0) / (t1 - t0)
+        return self.curve[-1][1]
+
+    def update_faults(self):
+        """
+        Logs start and end of every fault once
+        """
+        t = self.now()
+        faults = set()
+        for gpu, window in self.dropouts:
+            if self.is_active(window, t):
+                faults.add(('dropout', gpu, window))
+        for window in self.hangs:
+            if self.is_active(window, t):
+                faults.add(('hang', None, window))
+
+        with self.lock:
+            started, ended = faults - self.faults, self.faults - faults
+            self.faults = faults
+        for kind, gpu, window in sorted(started, key=str):
+            self.event('{}_start'.format(kind), gpu=gpu)
+        for kind, gpu, window in sorted(ended, key=str):
+            self.event('{}_end'.format(kind), gpu=gpu)
+
+    def gpu_factors(self):
+        self.update_faults()
+        factor = self.factor(self.now())
+        down = {gpu for kind, gpu, window in self.faults if kind == 'dropout'}
+        return [0.0 if idx in down else factor for idx in range(self.gpus)]
+
+    def is_hung(self):
+        self.update_faults()
+        return any(kind == 'hang' for kind, gpu, window in self.faults)
+
+    def wait_hang(self, api):
+        """
+        Holds the request while the API is hung
+        """
+        if self.is_hung():
+            self.event('request_hung', api=api)
+        while self.is_hung():
+            time.sleep(0.1)
+
+    def delay(self):
+        delay = args.latency + random.uniform(0, args.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def uptime(self):
+        return self.now() - self.restart_t
+
+    def shares(self, factor):
+        return int(self.uptime() * factor / 10)
+
+    def restart(self, source):
+        """
+        Miner restart: uptime and shares start over, active faults are fixed
+        """
+        t = self.now()
+        with self.lock:
+            since = [t - window[0] for kind, gpu, window in self.faults]
+        self.event('restart', source=source, reaction=round(max(since), 3) if since else None)
+        with self.lock:
+            self.restart_t = t
+            self.restarts += 1
+        self.update_faults()
+
+
+def ethminer_stat(rig, base):
+    factors = rig.gpu_factors()
+    khs = [int(base * x * 1000) for x in factors]
+    temps = ';'.join('{};{}'.format(60 + idx, 50) for idx in range(rig.gpus))
+    return [
+        '0.18.0-sim', str(int(rig.uptime() / 60)),
+        '{};{};0'.format(sum(khs), rig.shares(sum(factors))),
+        ';'.join(str(x) for x in khs),
+        '0;0;0', ';'.join('off' for x in khs),
+        temps, 'sim.pool:4444', '0;{};0;0'.format(rig.restarts),
+    ]
+
+
+class EthminerHandler(socketserver.StreamRequestHandler):
+    """
+    Line delimited JSON-RPC, the connection stays open
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                req = json.loads(line.decode('utf-8'))
+            except ValueError:
+                return
+            RIG.wait_hang('ethminer')
+            RIG.delay()
+
+            method = req.get('method')
+            if method in ('miner_getstat1', 'miner_getstat2'):
+                resp = dict(id=req.get('id'), jsonrpc='2.0', result=ethminer_stat(RIG, args.hashrate[0]))
+            elif method == 'miner_restart':
+                RIG.restart('ethminer_rpc')
+                resp = dict(id=req.get('id'), jsonrpc='2.0', result=True)
+            else:
+                resp = dict(id=req.get('id'), jsonrpc='2.0', error=dict(code=-32601, message='Method not found'))
+            RIG.event('request', api='ethminer', method=method)
+            try:
+                self.wfile.write(json.dumps(resp).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                RIG.event('client_gone', api='ethminer')
+                return
+
+
+class EwbfHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        RIG.wait_hang('ewbf')
+        RIG.delay()
+
+        if self.path.split('?')[0].strip('/') != 'getstat':
+            self.send_error(404)
+            return
+
+        factors = RIG.gpu_factors()
+        result = []
+        for idx, factor in enumerate(factors):
+            result.append(dict(
+                gpuid=idx, cudaid=idx, busid='0000:{:02x}:00.0'.format(idx + 1), name='GeForce GTX 1070',
+                gpu_status=2, solver=0, temperature=60 + idx, gpu_power_usage=int(120 * max(factor, 0.3)),
+                speed_sps=int(args.hashrate[1 % len(args.hashrate)] * factor),
+                accepted_shares=RIG.shares(factor), rejected_shares=0, start_time=RIG.start_time,
+            ))
+        body = json.dumps(dict(
+            id=1, method='getstat', error=None, start_time=RIG.start_time, current_server='sim.pool:3857',
+            available_servers=1, server_status=2, result=result,
+        )).encode('utf-8')
+
+        RIG.event('request', api='ewbf', method='getstat')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            RIG.event('client_gone', api='ewbf')
+            self.close_connection = True
+
+    def log_message(self, format, *a):
+        log.debug(format % a)
+
+
+def ccminer_reply(rig, command, base):
+    factors = rig.gpu_factors()
+    khs = [base * x for x in factors]
+
+    if command == 'summary':
+        records = [[
+            ('NAME', 'ccminer'), ('VER', '2.2.5-sim'), ('API', '1.9'), ('ALGO', 'lyra2v2'), ('GPUS', rig.gpus),
+            ('KHS', '{:.2f}'.format(sum(khs))), ('SOLV', 0), ('ACC', rig.shares(sum(factors))), ('REJ', 0),
+            ('ACCMN', 0), ('DIFF', 0), ('NETKHS', 0), ('POOLS', 1), ('WAIT', 0),
+            ('UPTIME', int(rig.uptime())), ('TS', int(time.time())),
+        ]]
+    elif command == 'threads':
+        records = [[
+            ('GPU', idx), ('BUS', idx + 1), ('CARD', 'GeForce GTX 1070'), ('TEMP', '{:.1f}'.format(60 + idx)),
+            ('POWER', int(120000 * max(factor, 0.3))), ('FAN', 50), ('RPM', 0), ('FREQ', 1900), ('MEMFREQ', 4000),
+            ('GPUF', 0), ('MEMF', 0), ('KHS', '{:.2f}'.format(khs[idx])), ('KHW', 0), ('PLIM', 0),
+            ('ACC', rig.shares(factor)), ('REJ', 0), ('HWF', 0), ('I', '20.0'), ('THR', 1048576),
+        ] for idx, factor in enumerate(factors)]
+    else:
+        return None
+
+    return ''.join(';'.join('{}={}'.format(k, v) for k, v in x) + '|' for x in records)
+
+
+class CcminerHandler(socketserver.BaseRequestHandler):
+    """
+    One command per connection, NUL terminated reply, then close (like ccminer)
+    """
+    def handle(self):
+        self.request.settimeout(5)
+        try:
+            command = self.request.recv(1024).decode('utf-8', 'replace').strip('\0\r\n ').split('|')[0]
+        except OSError:
+            return
+        RIG.wait_hang('ccminer')
+        RIG.delay()
+
+        reply = ccminer_reply(RIG, command, args.hashrate[2 % len(args.hashrate)])
+        RIG.event('request', api='ccminer', method=command)
+        try:
+            self.request.sendall((reply or '').encode('utf-8') + b'\0')
+        except OSError:
+            RIG.event('client_gone', api='ccminer')
+
+
+class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def run_server(name, server_class, port, handler):
+    server = server_class((args.host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True, name=name)
+    thread.start()
+    log.info('{} API listening on {}:{}'.format(name, args.host, port))
+    return server
+
+
+def on_sighup(signum, frame):
+    """
+    Miner process restart, e.g. --miner-restart-cmd "pkill -HUP -f [s]imulator.py"
+    """
+    threading.Thread(target=RIG.restart, args=('sighup', ), daemon=True).start()
+
+
+RIG = Rig(
+    gpus=args.gpus,
+    curve=parse_curve(args.curve),
+    dropouts=[(int(gpu), parse_window(window)) for gpu, window in (x.split('@', 1) for x in args.dropout)],
+    hangs=[parse_window(x) for x in args.hang],
+    event_log=args.event_log,
+)
+
+SERVERS = dict(
+    ethminer=(ThreadedTCPServer, args.ethminer_port, EthminerHandler),
+    ewbf=(ThreadedHTTPServer, args.ewbf_port, EwbfHandler),
+    ccminer=(ThreadedTCPServer, args.ccminer_port, CcminerHandler),
+)
+
+for name in args.miner:
+    run_server(name, *SERVERS[name])
+
+signal.signal(signal.SIGHUP, on_sighup)
+RIG.event('start', gpus=args.gpus, miners=','.join(args.miner))
+
+try:
+    while True:
+        RIG.update_faults()
+        time.sleep(0.1)
+except KeyboardInterrupt:
+    RIG.event('stop')
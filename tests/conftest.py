@@ -0,0 +1,34 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+
+def load_script(rel_path, name, argv=()):
+    """
+    The tools are scripts which parse sys.argv on import, load them with a given command line
+    """
+    saved_argv = sys.argv
+    sys.argv = [rel_path] + list(argv)
+    try:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT_DIR, rel_path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = saved_argv
+    return module
+
+
+@pytest.fixture(scope='session')
+def miner():
+    return load_script('miner.py', 'rig_miner', ['--shm-path', ''])
+
+
+@pytest.fixture(scope='session')
+def api():
+    return load_script(os.path.join('api', 'api.py'), 'rig_api', ['--gpu-type', 'nvidia', '--shm-path', ''])
@@ -0,0 +1,168 @@
+import pytest
+
+
+NVML_ERROR_GPU_IS_LOST = 15
+
+
+class FakeNvml():
+    """
+    Stands in for ctypes.CDLL('libnvidia-ml.so.1'), handles are index + 1
+    """
+    def __init__(self, count=3, unsupported=(), lost=()):
+        self.count = count
+        self.unsupported = unsupported    # function names returning NVML_ERROR_NOT_SUPPORTED
+        self.lost = lost                  # card indexes failing on every dynamic query
+        self.calls = []
+
+    @staticmethod
+    def obj(ref):
+        return ref._obj
+
+    @staticmethod
+    def index(handle):
+        return handle.value - 1
+
+    def write(self, buf, value):
+        buf.value = value.encode('utf-8')
+        return 0
+
+    def nvmlInit_v2(self):
+        self.calls.append('init')
+        return 0
+
+    def nvmlSystemGetDriverVersion(self, buf, size):
+        return self.write(buf, '384.90')
+
+    def nvmlDeviceGetCount_v2(self, count):
+        self.obj(count).value = self.count
+        return 0
+
+    def nvmlDeviceGetHandleByIndex_v2(self, index, handle):
+        self.obj(handle).value = index + 1
+        return 0
+
+    def nvmlDeviceGetPciInfo_v3(self, handle, pci):
+        pci = self.obj(pci)
+        pci.domain, pci.bus, pci.device = 0, self.index(handle) + 1, 0
+        return 0
+
+    def nvmlDeviceGetName(self, handle, buf, size):
+        return self.write(buf, 'GeForce GTX 1070')
+
+    def nvmlDeviceGetUUID(self, handle, buf, size):
+        return self.write(buf, 'GPU-{:08d}'.format(self.index(handle)))
+
+    def nvmlDeviceGetVbiosVersion(self, handle, buf, size):
+        return self.write(buf, '86.04.50.00.70')
+
+    def nvmlDeviceGetMemoryInfo(self, handle, mem):
+        mem = self.obj(mem)
+        mem.total, mem.used = 8192 * 2 ** 20, 2048 * 2 ** 20
+        mem.free = mem.total - mem.used
+        return 0
+
+    def nvmlDeviceGetUtilizationRates(self, handle, util):
+        if self.index(handle) in self.lost:
+            return NVML_ERROR_GPU_IS_LOST
+        util = self.obj(util)
+        util.gpu, util.memory = 95, 40
+        return 0
+
+    def uint(self, name, ref, value):
+        if name in self.unsupported:
+            return 3
+        self.obj(ref).value = value
+        return 0
+
+    def nvmlDeviceGetCurrPcieLinkGeneration(self, handle, value):
+        return self.uint('nvmlDeviceGetCurrPcieLinkGeneration', value, 1)
+
+    def nvmlDeviceGetTemperature(self, handle, sensor, value):
+        return self.uint('nvmlDeviceGetTemperature', value, 60 + self.index(handle))
+
+    def nvmlDeviceGetFanSpeed(self, handle, value):
+        return self.uint('nvmlDeviceGetFanSpeed', value, 70)
+
+    def nvmlDeviceGetPowerUsage(self, handle, value):
+        return self.uint('nvmlDeviceGetPowerUsage', value, 120500)
+
+    def nvmlDeviceGetClockInfo(self, handle, clock, value):
+        return self.uint('nvmlDeviceGetClockInfo', value, 1900 if clock == 1 else 4000)
+
+
+@pytest.fixture
+def fake_cdll(api, monkeypatch):
+    def patch(lib):
+        def cdll(name):
+            if lib is None:
+                raise OSError('{}: cannot open shared object file'.format(name))
+            return lib
+        monkeypatch.setattr(api.ctypes, 'CDLL', cdll)
+    return patch
+
+
+def test_init_and_static_data(api, fake_cdll):
+    lib = FakeNvml(count=2)
+    fake_cdll(lib)
+
+    gpu = api.NvmlGpu('libnvidia-ml.so.1')
+    assert lib.calls == ['init']
+    assert len(gpu.handles) == 2
+    card = gpu.static_data[1]
+    assert card['index'] == 1
+    assert card['name'] == 'card01'
+    assert card['card_model'] == 'GeForce GTX 1070'
+    assert card['uuid'] == 'GPU-00000001'
+    assert card['bus_id'] == '00000000:02:00.0'
+    assert card['driver_version'] == '384.90'
+    assert card['mem_total'] == 8192
+
+
+def test_get_data(api, fake_cdll):
+    fake_cdll(FakeNvml(count=2))
+
+    cards = api.NvmlGpu('libnvidia-ml.so.1').get_data()
+    assert [x['index'] for x in cards] == [0, 1]
+    card = cards[1]
+    assert card['core_load'] == 95
+    assert card['mem_load'] == 40
+    assert card['temp'] == 61
+    assert card['fan'] == 70
+    assert card['power_current'] == 120
+    assert card['core_clock'] == 1900
+    assert card['mem_clock'] == 4000
+    assert card['mem_used'] == 2048
+    assert card['pcie_gen'] == '1'
+
+
+def test_not_supported_is_zero(api, fake_cdll):
+    fake_cdll(FakeNvml(count=1, unsupported=('nvmlDeviceGetFanSpeed', )))
+
+    card = api.NvmlGpu('libnvidia-ml.so.1').get_data()[0]
+    assert card['fan'] == 0
+    assert card['temp'] == 60
+
+
+def test_failing_card_is_skipped(api, fake_cdll):
+    fake_cdll(FakeNvml(count=3, lost=(1, )))
+
+    cards = api.NvmlGpu('libnvidia-ml.so.1').get_data()
+    assert [x['index'] for x in cards] == [0, 2]
+
+
+def test_fallback_without_library(api, fake_cdll, monkeypatch):
+    fake_cdll(None)
+    monkeypatch.setattr(api.args, 'nvidia_backend', 'nvml')
+
+    gpu = api.make_gpu_data()
+    assert type(gpu) is api.NvidiaGpu
+
+
+def test_fallback_on_init_error(api, fake_cdll, monkeypatch):
+    lib = FakeNvml()
+    lib.nvmlInit_v2 = lambda: 9    # NVML_ERROR_DRIVER_NOT_LOADED
+    fake_cdll(lib)
+    monkeypatch.setattr(api.args, 'nvidia_backend', 'nvml')
+
+    gpu = api.make_gpu_data()
+    assert type(gpu) is api.NvidiaGpu
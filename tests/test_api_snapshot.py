@@ -0,0 +1,70 @@
+import gzip
+import types
+
+import pytest
+
+from app.httpcache import accepts_gzip
+
+
+@pytest.fixture
+def snapshot():
+    body = b'[{"cards": []}]'
+    return types.SimpleNamespace(
+        body=body, body_gzip=gzip.compress(body), ts=1.0,
+        etag='"abc"', etag_gzip='"abc-gz"',
+    )
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('', False),
+    ('gzip', True),
+    ('gzip, deflate, br', True),
+    ('deflate, gzip;q=0.5', True),
+    ('GZIP; Q=1.0', True),
+    ('gzip;q=0', False),
+    ('gzip; q=0.000', False),
+    ('deflate, gzip;q=0, *', False),
+    ('x-gzip', True),
+    ('*', True),
+    ('*;q=0', False),
+    ('identity', False),
+    ('gzip;q=bad', False),
+])
+def test_accepts_gzip(header, expected):
+    assert accepts_gzip(header) is expected
+
+
+def test_identity_and_gzip_etags_differ(api, snapshot):
+    code, headers, body = api.snapshot_response(snapshot, {})
+    headers = dict(headers)
+    assert code == 200
+    assert body == snapshot.body
+    assert headers['ETag'] == '"abc"'
+    assert 'Content-Encoding' not in headers
+
+    code, headers, body = api.snapshot_response(snapshot, {'Accept-Encoding': 'gzip'})
+    headers = dict(headers)
+    assert code == 200
+    assert gzip.decompress(body) == snapshot.body
+    assert headers['ETag'] == '"abc-gz"'
+    assert headers['Content-Encoding'] == 'gzip'
+    assert headers['Vary'] == 'Accept-Encoding'
+
+
+def test_gzip_refused_with_zero_q(api, snapshot):
+    code, headers, body = api.snapshot_response(snapshot, {'Accept-Encoding': 'gzip;q=0'})
+    assert body == snapshot.body
+    assert dict(headers)['ETag'] == '"abc"'
+
+
+def test_not_modified_per_encoding(api, snapshot):
+    code, headers, body = api.snapshot_response(snapshot, {'Accept-Encoding': 'gzip', 'If-None-Match': '"abc-gz"'})
+    assert code == 304
+    assert dict(headers)['ETag'] == '"abc-gz"'
+
+    # the identity ETag must not validate a cached gzip body and vice versa
+    code, headers, body = api.snapshot_response(snapshot, {'Accept-Encoding': 'gzip', 'If-None-Match': '"abc"'})
+    assert code == 200
+    code, headers, body = api.snapshot_response(snapshot, {'If-None-Match': '"abc-gz"'})
+    assert code == 200
+    assert body == snapshot.body
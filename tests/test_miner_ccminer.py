@@ -0,0 +1,144 @@
+import socketserver
+import threading
+
+import pytest
+
+
+class FakeCcminer(socketserver.BaseRequestHandler):
+    """
+    Like ccminer: one command per connection, NUL terminated reply, then close
+    """
+    def handle(self):
+        command = self.request.recv(1024).decode('utf-8').strip('\0\r\n ')
+        self.server.connections += 1
+        self.server.commands.append(command)
+
+        if command == 'summary':
+            reply = 'NAME=ccminer;VER=2.2.5;API=1.9;ALGO=lyra2v2;GPUS={};KHS={:.2f};ACC=12;REJ=1;UPTIME=100|'.format(
+                len(self.server.hashrates), sum(self.server.hashrates)
+            )
+        elif command == 'threads':
+            reply = ''.join(
+                'GPU={0};BUS={1};CARD=GTX 1070;TEMP=60.0;POWER=120500;FAN=50;KHS={2:.2f};ACC=6;REJ=0|'.format(idx, idx + 1, khs)
+                for idx, khs in enumerate(self.server.hashrates)
+            )
+        else:
+            reply = ''
+        self.request.sendall(reply.encode('utf-8') + b'\0')
+
+
+class FakeCcminerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, hashrates):
+        super().__init__(('127.0.0.1', 0), FakeCcminer)
+        self.hashrates = hashrates
+        self.connections = 0
+        self.commands = []
+
+
+@pytest.fixture
+def ccminer_api():
+    server = FakeCcminerServer([20000.0, 20000.0])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def clients():
+    """
+    Miner API clients to close after the test, the last connection stays open
+    """
+    clients = []
+    yield clients
+    for client in clients:
+        client.close()
+
+
+def test_parse_reply(miner):
+    client = miner.CcMinerClient('127.0.0.1', 0)
+    records = client.parse_reply(b'GPU=0;KHS=1.50|GPU=1;KHS=2.00|')
+    assert records == [dict(GPU='0', KHS='1.50'), dict(GPU='1', KHS='2.00')]
+    assert client.parse_reply(b'') == []
+
+
+def test_summary_and_threads(miner, ccminer_api, clients):
+    cc = miner.CcMiner(minimal_hashrate=30000, host='127.0.0.1', port=ccminer_api.server_address[1])
+    clients.append(cc.api)
+
+    data = cc.get_data()
+    assert ccminer_api.commands == ['summary', 'threads']
+    assert cc.cur_hashrate == 40000.0
+    assert cc.summary['GPUS'] == '2'
+    assert list(data) == [0, 1]
+    assert data[1]['hashrate'] == 20000.0
+    assert data[1]['power'] == 120.5
+    assert data[1]['accepted'] == 6
+
+
+def test_reconnect_after_close(miner, ccminer_api, clients):
+    client = miner.CcMinerClient('127.0.0.1', ccminer_api.server_address[1])
+    clients.append(client)
+
+    for x in range(3):
+        assert client.query('summary')[0]['NAME'] == 'ccminer'
+    # the server closes after every reply, each query used a new connection
+    assert ccminer_api.connections == 3
+    assert client.failures == 0
+
+
+def test_api_down(miner, clients):
+    server = FakeCcminerServer([])
+    port = server.server_address[1]
+    server.server_close()
+
+    cc = miner.CcMiner(minimal_hashrate=30000, host='127.0.0.1', port=port)
+    clients.append(cc.api)
+    assert cc.get_data() is None
+    assert cc.api.failures == 1
+    assert not cc.gpu_data
+
+
+def test_per_gpu_window(miner, ccminer_api, clients):
+    cc = miner.CcMiner(
+        minimal_hashrate=30000, host='127.0.0.1', port=ccminer_api.server_address[1], load_window=4, load_below=3,
+    )
+    clients.append(cc.api)
+    # past the warm up
+    cc.watchdog_start_time -= cc.sys_reboot_delay
+    reasons = []
+    cc.recover = lambda reason, delay=0: reasons.append(reason)
+
+    cc.watchdog()
+    assert not reasons
+
+    # total hashrate stays above the minimum, only one card is low
+    ccminer_api.hashrates[:] = [35000.0, 1000.0]
+    for x in range(2):
+        cc.watchdog()
+    assert not reasons
+    assert cc.HASHRATE[1].below == 2
+
+    cc.watchdog()
+    assert len(reasons) == 1
+    assert 'GPU01' in reasons[0] and 'GPU00' not in reasons[0]
+
+
+def test_window_threshold_change(miner):
+    window = miner.LoadWindow(2, 10)
+    window.push(5)
+    window.threshold = 3
+    window.push(5)
+    assert window.below == 1
+    # the first sample was counted against 10, evicting it must not leave it counted
+    window.push(5)
+    assert window.below == 0
+    window.threshold = 10
+    window.push(5)
+    window.push(5)
+    assert window.below == 2
+    assert window.average() == 5
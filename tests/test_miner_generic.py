@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+
+def sample(idx, load, ts=None, seq=0):
+    return {'index': idx, 'utilization.gpu': str(load), 'seq': ('test', seq), 'ts': ts or time.monotonic()}
+
+
+@pytest.fixture
+def generic(miner):
+    gm = miner.GenericMiner(minimal_gpu_load=50, load_window=4, load_below=3)
+    # past the warm up
+    gm.watchdog_start_time -= gm.sys_reboot_delay
+    gm.reasons = []
+    gm.recover = lambda reason, delay=0: gm.reasons.append(reason)
+    return gm
+
+
+def test_sampler_expires_old_samples(miner):
+    sampler = miner.SmiSampler(('utilization.gpu', ), 1)
+    sampler.samples = {0: sample(0, 90), 1: sample(1, 90, ts=time.monotonic() - 60)}
+
+    assert list(sampler.get_samples()) == [0, 1]
+    assert list(sampler.get_samples(5)) == [0]
+    assert list(sampler.samples) == [0]
+
+
+def test_missing_gpu_is_not_hidden(generic):
+    ticks = iter(range(1000))
+    generic.get_samples = lambda: {0: sample(0, 90, seq=next(ticks)), 1: sample(1, 90, seq=next(ticks))}
+    generic.watchdog()
+    assert not generic.reasons
+    assert generic.data_ts_delta == 0
+
+    # GPU01 falls out of the data while GPU00 keeps reporting
+    generic.get_samples = lambda: {0: sample(0, 90, seq=next(ticks))}
+    generic.watchdog()
+    assert generic.get_missing_gpus() == [1]
+    assert not generic.reasons
+
+    generic.gpu_ts[1] -= generic.sys_reboot_delay
+    generic.watchdog()
+    assert generic.data_ts_delta >= generic.sys_reboot_delay
+    assert len(generic.reasons) == 1
+    assert 'GPU01' in generic.reasons[0]
+
+
+def test_missing_gpu_ages_after_reset(generic):
+    generic.get_samples = lambda: {0: sample(0, 90), 1: sample(1, 90)}
+    generic.watchdog()
+    generic.get_samples = lambda: {0: sample(0, 90)}
+    generic.reset_state()
+
+    # a recovery action gives every known GPU a fresh grace period, but does not forget it
+    assert sorted(generic.gpu_ts) == [0, 1]
+    assert generic.data_ts_delta == 0
+    generic.watchdog_start_time -= generic.sys_reboot_delay
+    generic.watchdog()
+    assert generic.get_missing_gpus() == [1]
+    assert not generic.reasons
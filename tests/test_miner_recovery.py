@@ -0,0 +1,93 @@
+import pytest
+
+
+@pytest.fixture
+def events(miner, monkeypatch):
+    events = []
+    monkeypatch.setattr(miner, 'write_event', events.append)
+    return events
+
+
+@pytest.fixture
+def rig(miner, events):
+    class Rig(miner.BaseMiner):
+        def __init__(self):
+            super().__init__()
+            self.actions = []
+
+        def rpc_restart(self):
+            self.actions.append('rpc_restart')
+            return True
+
+        def proc_restart(self):
+            self.actions.append('proc_restart')
+            return True
+
+        def gpu_reset(self):
+            self.actions.append('gpu_reset')
+            return True
+
+        def sys_reboot(self, delay=0, fake=False):
+            self.actions.append('reboot')
+
+        def end_cooldown(self):
+            self.recovery_ts -= self.recovery_cooldown[self.recovery_action]
+
+    return Rig()
+
+
+def test_healthy_tick_during_cooldown_is_not_success(rig, events):
+    rig.recover('low hashrate')
+    rig.recovered()
+    assert rig.recovery_action == 'rpc_restart'
+    assert not any('helped' in x for x in events)
+
+    rig.end_cooldown()
+    rig.recovered()
+    assert rig.recovery_action is None
+    assert events[-1] == 'Recovery: rpc_restart helped'
+
+
+def test_recurring_failure_escalates(rig, events):
+    for x in range(4):
+        rig.recover('low hashrate')
+        rig.end_cooldown()
+        rig.recovered()
+    assert rig.actions == ['rpc_restart', 'proc_restart', 'gpu_reset', 'reboot']
+
+
+def test_relapse_during_cooldown(rig, events):
+    rig.recover('low hashrate')
+    rig.recover('low hashrate')
+    assert rig.actions == ['rpc_restart']
+
+    rig.end_cooldown()
+    rig.recovered()
+    assert 'did not hold' in events[-1]
+    rig.recover('low hashrate')
+    assert rig.actions == ['rpc_restart', 'proc_restart']
+
+
+def test_ladder_reset_after_quiet_period(miner, rig, events):
+    rig.recover('low hashrate')
+    rig.end_cooldown()
+    rig.recovered()
+    assert rig.recovery_level == 1
+
+    rig.failure_ts -= miner.args.recovery_reset_after
+    rig.recovered()
+    assert rig.recovery_level == 0
+    rig.recover('low hashrate')
+    assert rig.actions == ['rpc_restart', 'rpc_restart']
+
+
+@pytest.mark.parametrize('reply, expected', [
+    ({'id': 1, 'jsonrpc': '2.0', 'result': True}, True),
+    ({'id': 1, 'jsonrpc': '2.0', 'result': False}, False),
+    (None, False),
+])
+def test_ethminer_rpc_restart_result(miner, reply, expected):
+    eth = miner.EthMiner(minimal_hashrate=100, host='127.0.0.1', port=0)
+    eth.rpc.call = lambda method: reply
+    assert eth.rpc_restart() is expected
+    eth.rpc.close()
@@ -0,0 +1,49 @@
+import pytest
+
+
+def test_parse_watch(miner):
+    name, opts = miner.parse_watch(['ethminer', 'port=3333', 'url=/a=b', 'host='])
+    assert name == 'ethminer'
+    assert opts == {'port': '3333', 'url': '/a=b', 'host': ''}
+
+
+@pytest.mark.parametrize('spec', [
+    ['ethminer', 'port'],
+    ['ethminer', '=3333'],
+    ['nosuchminer', 'port=3333'],
+])
+def test_parse_watch_exits(miner, spec):
+    with pytest.raises(SystemExit) as e:
+        miner.parse_watch(spec)
+    assert e.value.code == 1
+
+
+def test_parse_gpus(miner):
+    assert miner.parse_gpus('0-3,6') == [0, 1, 2, 3, 6]
+
+
+class FakeKmsg():
+    def __init__(self, events):
+        self.events = events
+
+    def pop_new(self):
+        events, self.events = self.events, []
+        return events
+
+
+def test_fatal_xid_reboot_is_recorded(miner, monkeypatch):
+    events, reboots = [], []
+    monkeypatch.setattr(miner, 'KMSG', FakeKmsg([
+        dict(bus_id='0000:01:00', xid=13, line='NVRM: Xid (PCI:0000:01:00): 13'),
+        dict(bus_id='0000:02:00', xid=79, line='NVRM: Xid (PCI:0000:02:00): 79'),
+    ]), raising=False)
+    monkeypatch.setattr(miner, 'write_event', events.append)
+    monkeypatch.setattr(miner, 'sys_reboot', lambda delay=0, fake=False: reboots.append(delay))
+
+    miner.check_gpu_faults()
+    assert reboots == [30]
+    assert events == ['Recovery: reboot after: Fatal Xid 79 on 0000:02:00']
+
+    # the events are consumed, the next tick does nothing
+    miner.check_gpu_faults()
+    assert reboots == [30]